@@ -0,0 +1,97 @@
+"""Count JPEG encode passes and CPU time per image for the compressor.
+
+The legacy loop is capped at MAX_LEGACY_PASSES because it never ends on
+images that stay above the target at quality 10.
+
+Run from the repository root: python -m benchmarks.image_compression
+"""
+
+import os
+import tempfile
+import time
+
+from PIL import Image
+
+from utils import image_utils
+
+MAX_LEGACY_PASSES = 20
+SAMPLES = [
+    ("small photo", (1200, 900), 95),
+    ("large photo", (4000, 3000), 95),
+    ("oversized panorama", (9000, 1500), 95),
+    ("huge noise", (5000, 5000), 100),
+]
+
+
+def write_sample(directory: str, name: str, size, quality: int) -> str:
+    path = os.path.join(directory, f"{name.replace(' ', '_')}.jpg")
+    noise = Image.effect_noise((size[0] // 8, size[1] // 8), 80).convert("RGB")
+    noise.resize(size).save(path, quality=quality)
+    return path
+
+
+def legacy_prepare(image_path: str, output_path: str):
+    passes = 0
+    with Image.open(image_path) as img:
+        width, height = img.width, img.height
+        if not (10 <= width <= 5000 and 10 <= height <= 5000):
+            img = img.resize(
+                (min(max(10, width), 5000), min(max(10, height), 5000)), Image.LANCZOS
+            )
+            img.save(output_path, format="JPEG", quality=50)
+            passes += 1
+            image_path = output_path
+
+    while os.path.getsize(image_path) > 550 * 1024 and passes < MAX_LEGACY_PASSES:
+        with Image.open(image_path) as img:
+            img.load()
+            img.save(output_path, format="JPEG", quality=10)
+        image_path = output_path
+        passes += 1
+    return passes, os.path.getsize(image_path)
+
+
+def adaptive_prepare(image_path: str, output_path: str):
+    passes = 0
+    encode_jpeg = image_utils.encode_jpeg
+
+    def counting_encode(img, quality):
+        nonlocal passes
+        passes += 1
+        return encode_jpeg(img, quality)
+
+    image_utils.encode_jpeg = counting_encode
+    image_utils.IMAGES_CACHE_PATH = os.path.join(os.path.dirname(output_path), "cache")
+    try:
+        cache_path = image_utils.prepare_image(image_path)
+    finally:
+        image_utils.encode_jpeg = encode_jpeg
+
+    size = os.path.getsize(cache_path)
+    os.remove(cache_path)
+    return passes, size
+
+
+def measure(label, prepare, image_path, output_path):
+    started = time.process_time()
+    passes, size = prepare(image_path, output_path)
+    elapsed = time.process_time() - started
+    print(
+        f"  {label:>8}: {passes:3} encodes, {elapsed:6.2f} s CPU, {size // 1024:6} KiB"
+    )
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        output_path = os.path.join(directory, "output.jpg")
+        for name, size, quality in SAMPLES:
+            image_path = write_sample(directory, name, size, quality)
+            print(
+                f"{name} {size[0]}x{size[1]}, {os.path.getsize(image_path) // 1024} KiB"
+            )
+            measure("legacy", legacy_prepare, image_path, output_path)
+            measure("adaptive", adaptive_prepare, image_path, output_path)
+
+
+if __name__ == "__main__":
+    main()
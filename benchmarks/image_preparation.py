@@ -0,0 +1,68 @@
+"""Measure tree load time with many referenced images.
+
+Compares serial and parallel preparation on an empty derivative cache,
+then a reload that hits the content-addressed cache.
+
+Run from the repository root: python -m benchmarks.image_preparation [images]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+IMAGES = 1000
+
+
+def write_images(directory: str, count: int):
+    noise = Image.effect_noise((400, 300), 64).convert("RGB")
+    for index in range(count):
+        size = (5200, 400) if index % 10 == 0 else (1200, 900)
+        noise.resize(size).rotate(index % 360).save(
+            os.path.join(directory, f"{index}.jpg"), quality=95
+        )
+
+
+def write_tree(directory: str, count: int) -> str:
+    tree_path = os.path.join(directory, "tree.txt")
+    with open(tree_path, "w", encoding="utf-8") as file:
+        file.write("0|Welcome|Start|0\n")
+        for index in range(1, count * 3):
+            file.write(f"{index}|Text {index}|Option {index}|{index % count}\n")
+    return tree_path
+
+
+def measure(label, tree_path, workers):
+    from bot.messages.parsing.parser import read_message_records
+    from bot.messages.parsing import parser
+
+    parser.IMAGES_WORKERS = workers
+    started = time.perf_counter()
+    _, images = read_message_records(tree_path)
+    elapsed = time.perf_counter() - started
+    print(f"{label:>24}: {elapsed:7.2f} s ({len(images)} images)")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else IMAGES
+    workers = os.cpu_count() or 1
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["IMAGES_PATH"] = directory
+        write_images(directory, count)
+        tree_path = write_tree(directory, count)
+
+        from utils import image_utils
+
+        cache_root = image_utils.IMAGES_CACHE_PATH
+        image_utils.IMAGES_CACHE_PATH = os.path.join(cache_root, "serial")
+        measure("cold, 1 worker", tree_path, 1)
+        image_utils.IMAGES_CACHE_PATH = os.path.join(cache_root, "parallel")
+        measure(f"cold, {workers} workers", tree_path, workers)
+        measure("warm cache", tree_path, workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Compare recursive dotted-id traversal with the flat node index.
+
+Run from the repository root: python -m benchmarks.node_lookup
+"""
+
+import random
+import time
+
+from bot.messages.message_node import MessageNode, RootNode
+
+NODES = 100_000
+DEPTH = 12
+
+
+def legacy_get_node(choices, node_id, current=0):
+    """Walk per-node {node_id: (node, choices)} dicts, as nodes were once linked."""
+    if isinstance(node_id, str):
+        node_id = node_id.split(".")
+
+    if current == len(node_id) - 1:
+        return choices.get(".".join(node_id), (None,))[0]
+
+    return legacy_get_node(
+        choices.get(".".join(node_id[: current + 1]))[1], node_id, current + 1
+    )
+
+
+def build_tree(nodes: int = NODES, depth: int = DEPTH, branching: int = 10):
+    root = RootNode("root", "root")
+    legacy = {"": {}}
+    ids = []
+    level = [""]
+    for current_depth in range(depth):
+        width = min(
+            len(level) * branching, (nodes - len(ids)) // (depth - current_depth)
+        )
+        next_level = []
+        for position in range(width):
+            parent_id = level[position % len(level)]
+            index = position // len(level) + 1
+            node_id = f"{parent_id}.{index}" if parent_id else str(index)
+            node = MessageNode(node_id, node_id, position=len(ids) + position + 1)
+            root.add_node(node_id, node)
+            legacy[node_id] = {}
+            legacy[parent_id][node_id] = (node, legacy[node_id])
+            next_level.append(node_id)
+        ids.extend(next_level)
+        level = next_level
+    return root, legacy[""], ids
+
+
+def measure(label, lookup, ids):
+    started = time.perf_counter()
+    for node_id in ids:
+        lookup(node_id)
+    elapsed = time.perf_counter() - started
+    print(f"{label:>10}: {elapsed * 1e9 / len(ids):8.0f} ns/lookup")
+
+
+def main():
+    root, legacy, ids = build_tree()
+    deepest = max(node_id.count(".") for node_id in ids) + 1
+    print(f"{len(ids)} nodes, depth {deepest}")
+
+    sample = random.choices(ids, k=200_000)
+    deep = [node_id for node_id in ids if node_id.count(".") == deepest - 1]
+    deep_sample = random.choices(deep, k=200_000)
+
+    measure("recursive", lambda node_id: legacy_get_node(legacy, node_id), sample)
+    measure("index", root.get_node, sample)
+    print("deepest level only:")
+    measure("recursive", lambda node_id: legacy_get_node(legacy, node_id), deep_sample)
+    measure("index", root.get_node, deep_sample)
+
+
+if __name__ == "__main__":
+    main()
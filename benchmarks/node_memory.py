@@ -0,0 +1,84 @@
+"""Report memory per node for the slotted MessageNode against a __dict__-based one.
+
+Only the root keeps the node-id index and the tree version; other nodes store
+their position and compute callback data from it when a keyboard is rendered.
+
+Run from the repository root: python -m benchmarks.node_memory
+"""
+
+import gc
+import tracemalloc
+
+from benchmarks.node_lookup import DEPTH, NODES
+from bot.messages.message_node import MessageNode, RootNode
+
+
+class DictMessageNode:
+    """The indexed node before slots: a per-instance __dict__ and choices."""
+
+    def __init__(self, text: str, short_text: str, image: str = None):
+        self.text = text
+        self.image = image
+        self.short_text = short_text
+        self.choices = dict()
+        self.parent = None
+        self.index = None
+
+    def add_node(self, node_id, node):
+        if self.index is None:
+            self.index = dict()
+
+        separator = node_id.rfind(".")
+        parent = self.index[node_id[:separator]] if separator != -1 else self
+        parent.choices[node_id] = node
+        node.parent = parent
+        self.index[node_id] = node
+
+
+def generate_rows(nodes: int = NODES, depth: int = DEPTH, branching: int = 10):
+    rows = []
+    level = [""]
+    for current_depth in range(depth):
+        width = min(
+            len(level) * branching, (nodes - len(rows)) // (depth - current_depth)
+        )
+        next_level = []
+        for position in range(width):
+            parent_id = level[position % len(level)]
+            index = position // len(level) + 1
+            node_id = f"{parent_id}.{index}" if parent_id else str(index)
+            image = f"./images/{index % 50}.jpg" if index % 3 == 0 else None
+            rows.append((node_id, f"Text {node_id}", f"Button {index}", image))
+            next_level.append(node_id)
+        level = next_level
+    return rows
+
+
+def measure(label, root_class, node_class, rows):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    root = root_class("root", "root")
+    for position, (node_id, text, short_text, image) in enumerate(rows, 1):
+        # Copy strings so both variants start from equal, unshared inputs.
+        node = node_class("".join(text), "".join(short_text), image and "".join(image))
+        if hasattr(node, "position"):
+            node.position = position
+        root.add_node("".join(node_id), node)
+
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{label:>8}: {used / 2**20:7.1f} MiB, {used / len(rows):6.0f} B/node")
+    return root
+
+
+def main():
+    rows = generate_rows()
+    print(f"{len(rows)} nodes")
+    measure("dict", DictMessageNode, DictMessageNode, rows)
+    measure("slotted", RootNode, MessageNode, rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Measure tree parser throughput in lines per second.
+
+Also times one call of each way of escaping a line of text:
+
+* replace - the chain of str.replace calls prepare_text uses;
+* regex   - a single pass with a precompiled character class;
+* table   - a single pass with a precompiled str.translate table.
+
+The single-pass variants are kept to show why prepare_text does not use
+them: in CPython each str.replace is a fast C search that returns the string
+unchanged when the character is absent, while translate looks every
+character up in the table and re.sub builds the result match by match.
+
+Run from the repository root: python -m benchmarks.parser_throughput [lines]
+"""
+
+import os
+import re
+import sys
+import tempfile
+import time
+import timeit
+
+from bot.messages.parsing.parser import iter_lines, parse_message_lines
+
+LINES = 2_000_000
+ESCAPE_CALLS = 200_000
+ESCAPE_CHARS = re.compile(r"[.!#+=()-]")
+ESCAPE_TABLE = str.maketrans({char: "\\" + char for char in ".!#+=-()"})
+SAMPLE_TEXT = "Step 1234. Call (555) 010-1234! More: https://example.com/page_1234"
+
+
+def legacy_prepare_text(text: str):
+    text = (
+        text.strip()
+        .replace("\\n", "\n")
+        .replace(".", "\\.")
+        .replace("!", "\\!")
+        .replace("#", "\\#")
+        .replace("+", "\\+")
+        .replace("=", "\\=")
+        .replace("-", "\\-")
+        .replace("(", "\\(")
+        .replace(")", "\\)")
+    )
+    return re.sub(r"(https?://\S+)_", r"\1\\_", text)
+
+
+def replace_escape(text: str):
+    return (
+        text.replace(".", r"\.")
+        .replace("!", r"\!")
+        .replace("#", r"\#")
+        .replace("+", r"\+")
+        .replace("=", r"\=")
+        .replace("-", r"\-")
+        .replace("(", r"\(")
+        .replace(")", r"\)")
+    )
+
+
+def regex_escape(text: str):
+    return ESCAPE_CHARS.sub(r"\\\g<0>", text)
+
+
+def table_escape(text: str):
+    return text.translate(ESCAPE_TABLE)
+
+
+def legacy_parse(file_path: str):
+    records = []
+    with open(file_path, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            parts = line.split("|")
+            records.append(
+                (
+                    parts[0].strip(),
+                    legacy_prepare_text(parts[1]),
+                    parts[2].strip(),
+                    parts[3].strip(),
+                )
+            )
+    return records
+
+
+def streaming_parse(file_path: str):
+    with open(file_path, "r", encoding="utf-8") as file:
+        return parse_message_lines(iter_lines(file))
+
+
+def write_tree(file_path: str, lines: int):
+    with open(file_path, "w", encoding="utf-8") as file:
+        file.write("0|Welcome!|Start|\n")
+        for number in range(1, lines):
+            node_id = f"{number % 1000 + 1}.{number}" if number > 1000 else str(number)
+            file.write(
+                f"{node_id}|Step {number}. Call (555) 010-{number % 10000}! "
+                f"More: https://example.com/page_{number}|Option {number}|\n"
+            )
+
+
+def measure(label, parse, file_path, lines):
+    started = time.perf_counter()
+    parse(file_path)
+    elapsed = time.perf_counter() - started
+    print(f"{label:>10}: {lines / elapsed:12,.0f} lines/s ({elapsed:.2f} s)")
+
+
+def measure_escape(label, escape):
+    elapsed = timeit.timeit(lambda: escape(SAMPLE_TEXT), number=ESCAPE_CALLS)
+    print(f"{label:>10}: {elapsed / ESCAPE_CALLS * 1e9:8,.0f} ns/call")
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else LINES
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, "tree.txt")
+        write_tree(file_path, lines)
+        print(f"{lines} lines, {os.path.getsize(file_path) / 2**20:.0f} MiB")
+        measure("legacy", legacy_parse, file_path, lines)
+        measure("streaming", streaming_parse, file_path, lines)
+
+    expected = replace_escape(SAMPLE_TEXT)
+    assert regex_escape(SAMPLE_TEXT) == table_escape(SAMPLE_TEXT) == expected
+    print(f"escaping {SAMPLE_TEXT!r}")
+    measure_escape("replace", replace_escape)
+    measure_escape("regex", regex_escape)
+    measure_escape("table", table_escape)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Measure event loop stalls while creating YooKassa payments.
+
+A stub payments API runs in its own thread and answers after LATENCY
+seconds. While payments are being created, a ticker task on the bot's loop
+sleeps TICK seconds at a time and records how late it wakes up, which is
+how long updates and webhooks would have been stuck.
+
+* sdk    - the old path, the SDK's blocking Payment.create in a coroutine;
+* pooled - PaymentApiClient, aiohttp with a keep-alive connection pool.
+
+Run from the repository root: python -m benchmarks.payment_api
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+from aiohttp import web
+from yookassa import Configuration, Payment
+
+os.environ.setdefault("PAYMENT_EMAIL", "payer@example.com")
+os.environ.setdefault("PAYMENT_PHONE", "79000000000")
+
+from payment.client import api_client, build_payment_request, get_idempotency_key
+
+PAYMENTS = 50
+CONCURRENCY = 10
+LATENCY = 0.05
+TICK = 0.005
+
+
+class StubApi:
+    def __init__(self):
+        self.requests = 0
+        self.connections = set()
+        self.port = None
+        self.ready = threading.Event()
+
+    async def create_payment(self, request: web.Request):
+        self.requests += 1
+        self.connections.add(request.transport.get_extra_info("peername"))
+        await request.json()
+        await asyncio.sleep(LATENCY)
+        key = request.headers["Idempotence-Key"]
+        return web.json_response(
+            {
+                "id": key,
+                "status": "pending",
+                "confirmation": {"confirmation_url": f"https://pay/{key}"},
+            }
+        )
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        app = web.Application()
+        app.router.add_post("/v3/payments", self.create_payment)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.ready.set()
+        await self.stopped.wait()
+        await runner.cleanup()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        self.ready.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def reset(self):
+        self.requests = 0
+        self.connections.clear()
+
+
+async def sdk_create(index: int):
+    Payment.create(build_payment_request(), get_idempotency_key(str(index)))
+
+
+async def pooled_create(index: int):
+    await api_client.create_payment(
+        build_payment_request(), get_idempotency_key(str(index))
+    )
+
+
+async def measure(create, stub: StubApi, label: str):
+    stalls = list()
+    running = True
+
+    async def ticker():
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(TICK)
+            stalls.append(time.perf_counter() - started - TICK)
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def payment(index: int):
+        async with semaphore:
+            await create(index)
+
+    await create(-1)
+    stub.reset()
+    task = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(payment(index) for index in range(PAYMENTS)))
+    elapsed = time.perf_counter() - started
+    running = False
+    await task
+
+    print(
+        f"{label:<8} {elapsed:6.2f} s total  "
+        f"max stall {max(stalls) * 1e3:7.1f} ms  "
+        f"stalled {sum(stalls) * 1e3:7.1f} ms  "
+        f"connections {len(stub.connections):>3}"
+    )
+
+
+async def main():
+    stub = StubApi().start()
+    Configuration.configure("shop", "secret")
+    Configuration.api_url = f"http://127.0.0.1:{stub.port}/v3"
+
+    print(
+        f"{PAYMENTS} payments, {CONCURRENCY} concurrent, "
+        f"{LATENCY * 1e3:.0f} ms API latency"
+    )
+    await measure(sdk_create, stub, "sdk")
+    await measure(pooled_create, stub, "pooled")
+
+    await api_client.close()
+    stub.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+"""Count Redis connections and round trips per payment, old layout vs shared pool.
+
+The old layout opened one client per logical database and ran the payment
+and user writes as two pipelines joined with asyncio.gather, followed by a
+separate PUBLISH, and the webhook read the payment record before confirming
+it. The shared pool runs each transition as one EVALSHA.
+Both run against an in-process RESP stub, so the numbers are protocol
+counts, not Redis server timings.
+
+Run from the repository root: python -m benchmarks.payment_round_trips
+"""
+
+import asyncio
+import json
+import os
+import time
+
+from redis import asyncio as aioredis
+
+from benchmarks.redis_stub import RedisStub
+
+PAYMENTS = 2_000
+CONCURRENCY = 20
+
+
+class LegacyPaymentManager:
+    def __init__(self, url: str):
+        self.users = aioredis.from_url(url, db=1, decode_responses=True)
+        self.payments = aioredis.from_url(url, db=2, decode_responses=True)
+
+    async def create_payment(self, client_id, payment_id, confirmation_url):
+        async with self.payments.pipeline(transaction=True) as pipe_payments:
+            pipe_payments.set(
+                payment_id,
+                json.dumps({"target_user": client_id, "responsible": client_id}),
+            )
+            async with self.users.pipeline(transaction=True) as pipe_users:
+                pipe_users.set(
+                    client_id,
+                    json.dumps({"confirmation_url": confirmation_url, "paid": False}),
+                )
+                await asyncio.gather(pipe_payments.execute(), pipe_users.execute())
+                await self.users.publish("payments:invalidate", client_id)
+
+    async def confirm_payment(self, payment_id):
+        await self.payments.get(payment_id)
+        client_id = payment_id.removeprefix("payment-")
+        async with self.users.pipeline(transaction=True) as pipe_users:
+            pipe_users.set(client_id, json.dumps({"paid": True}))
+            async with self.payments.pipeline(transaction=True) as pipe_payments:
+                pipe_payments.delete(payment_id)
+                await asyncio.gather(pipe_users.execute(), pipe_payments.execute())
+                await self.users.publish("payments:invalidate", client_id)
+
+    async def close(self):
+        await self.users.aclose()
+        await self.payments.aclose()
+
+
+async def run_payments(manager, stub: RedisStub, label: str):
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def payment(index: int):
+        async with semaphore:
+            client_id, payment_id = str(index), f"payment-{index}"
+            await manager.create_payment(client_id, payment_id, "https://pay/x")
+            await manager.confirm_payment(payment_id)
+
+    await payment(-1)
+    stub.reset_counters()
+    started = time.perf_counter()
+    await asyncio.gather(*(payment(index) for index in range(PAYMENTS)))
+    elapsed = time.perf_counter() - started
+
+    print(
+        f"{label:<12} connections {stub.connections:>4}  "
+        f"round trips/payment {stub.round_trips / PAYMENTS:5.2f}  "
+        f"commands/payment {stub.commands / PAYMENTS:5.2f}  "
+        f"{elapsed / PAYMENTS * 1e6:7.1f} us/payment"
+    )
+
+
+async def main():
+    stub = await RedisStub().start()
+    os.environ["DB_HOST"] = "127.0.0.1"
+    os.environ["DB_PORT"] = str(stub.port)
+    os.environ.pop("DB_USER", None)
+    os.environ.pop("DB_PASSWORD", None)
+
+    print(f"{PAYMENTS} payments (create + confirm), {CONCURRENCY} concurrent")
+
+    legacy = LegacyPaymentManager(f"redis://127.0.0.1:{stub.port}")
+    await run_payments(legacy, stub, "per-db")
+    await legacy.close()
+
+    from db.redis.client import close_connections, payments
+
+    stub.script_handler = lambda keys, args: [1, b"", b"", b"", b""]
+    await payments.load_scripts()
+    await run_payments(payments, stub, "shared pool")
+    await close_connections()
+    await stub.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,188 @@
+"""Compare encode/decode cost of the Redis value codecs and the memory taken
+by the paid flag in each layout.
+
+The payment record row compares the old json.dumps/json.loads pair with
+PaymentCodec, which encodes without spaces and decodes with raw_decode (falling
+back to json.loads when anything follows the value).
+
+Codec bytes are the value payload only. The paid bit itself lives in a
+users:paid:<shard> bitmap, so its cost depends on how the paid ids spread
+over shards. The layout section loads the same id sets into both layouts:
+
+* per-user key - the old users:<id> JSON record, one key per paid user;
+* bitmap       - users:paid:<shard> strings, each allocated up to its highest
+                 set bit (up to 8 bytes per shard), plus the users:paid-count
+                 counter.
+
+Without BENCH_REDIS_URL the sizes are modelled as payload plus an estimated
+KEY_OVERHEAD per key. With BENCH_REDIS_URL the keys are written under a
+bench: prefix, measured with MEMORY USAGE and deleted again, so point it at
+a scratch database.
+
+Run from the repository root: python -m benchmarks.redis_codec
+"""
+
+import json
+import os
+import random
+import timeit
+
+import redis
+
+from db.redis.client import PAID_SHARD_BITS, UserState, get_paid_position
+from db.redis.codec import PaymentCodec, StringCodec
+
+ROUNDS = 200_000
+CONFIRMATION_URL = "https://yoomoney.ru/checkout/payments/v2/contract?orderId=2e3f6c1a-000f-5000-8000-1b2c3d4e5f60"
+FILE_ID = "AgACAgIAAxkDAAIBZ2Zx1f3kq9W0mN8rT4vYh6cLpJqVAAJb2zEb8u1oS7xq3Z0mYy9hAQADAgADeQADNQQ"
+
+
+class LegacyJson:
+    def encode(self, value) -> str:
+        return json.dumps(value)
+
+    def decode(self, raw: str):
+        return json.loads(raw)
+
+
+class LegacyPaymentJson(LegacyJson):
+    def decode(self, raw: str):
+        value = json.loads(raw)
+        if not isinstance(value, dict):
+            value = {"responsible": value, "target_user": value}
+        return value
+
+
+class PaidBitmap:
+    def encode(self, value) -> tuple:
+        return int(value["paid"]), value.get("confirmation_url") or None
+
+    def decode(self, raw: tuple):
+        paid, confirmation_url = raw
+        return {
+            "paid": paid == 1,
+            "confirmation_url": confirmation_url or "",
+            "state": UserState.NONE.value,
+        }
+
+
+USERS = 10_000
+# dictEntry, robj and SDS headers of a small key, before allocator rounding
+KEY_OVERHEAD = 56
+PREFIX = "bench:"
+
+
+def get_size(raw) -> int:
+    if isinstance(raw, tuple):
+        paid, confirmation_url = raw
+        return len(confirmation_url.encode()) if confirmation_url else 0
+    return len(raw.encode())
+
+
+def get_id_sets() -> dict:
+    generator = random.Random(1)
+    return {
+        "sequential ids": range(10**9, 10**9 + USERS),
+        "telegram-like ids": generator.sample(range(10**8, 8 * 10**9), USERS),
+    }
+
+
+def build_layouts(client_ids) -> dict:
+    record = json.dumps({"paid": True})
+    per_user = {f"users:{client_id}": record for client_id in client_ids}
+
+    shards = dict()
+    for client_id in client_ids:
+        shard, offset = get_paid_position(client_id)
+        shards.setdefault(shard, set()).add(offset)
+    return {"per-user key": per_user, "bitmap": shards}
+
+
+def model_size(layout: str, keys: dict) -> int:
+    if layout == "per-user key":
+        return sum(KEY_OVERHEAD + len(key) + len(value) for key, value in keys.items())
+    bitmaps = sum(
+        KEY_OVERHEAD + len(f"users:paid:{shard}") + max(offsets) // 8 + 1
+        for shard, offsets in keys.items()
+    )
+    counter = KEY_OVERHEAD + len("users:paid-count") + len(str(USERS))
+    return bitmaps + counter
+
+
+def measure_size(client: redis.Redis, layout: str, keys: dict) -> int:
+    names = list()
+    with client.pipeline(transaction=False) as pipe:
+        if layout == "per-user key":
+            for key, value in keys.items():
+                names.append(PREFIX + key)
+                pipe.set(PREFIX + key, value)
+        else:
+            names.append(f"{PREFIX}users:paid-count")
+            pipe.set(names[0], USERS)
+            for shard, offsets in keys.items():
+                names.append(f"{PREFIX}users:paid:{shard}")
+                for offset in offsets:
+                    pipe.setbit(names[-1], offset, 1)
+        pipe.execute()
+
+    with client.pipeline(transaction=False) as pipe:
+        for name in names:
+            pipe.memory_usage(name, samples=0)
+        size = sum(pipe.execute())
+    for start in range(0, len(names), 1000):
+        client.delete(*names[start : start + 1000])
+    return size
+
+
+def measure(label: str, codec, value):
+    raw = codec.encode(value)
+    encode = timeit.timeit(lambda: codec.encode(value), number=ROUNDS) / ROUNDS
+    decode = timeit.timeit(lambda: codec.decode(raw), number=ROUNDS) / ROUNDS
+    print(
+        f"  {label:<14} encode {encode * 1e9:6.0f} ns  "
+        f"decode {decode * 1e9:6.0f} ns  {get_size(raw):4d} payload bytes"
+    )
+
+
+def main():
+    pending = {"confirmation_url": CONFIRMATION_URL, "paid": False}
+    paid = {"paid": True}
+    payment = {"target_user": 1234567890, "responsible": 987654321}
+
+    print("pending user")
+    measure("json string", LegacyJson(), pending)
+    measure("bit + pending", PaidBitmap(), pending)
+
+    print("paid user")
+    measure("json string", LegacyJson(), paid)
+    measure("paid bit", PaidBitmap(), paid)
+
+    print("payment record")
+    measure("json", LegacyPaymentJson(), payment)
+    measure("compact json", PaymentCodec(), payment)
+
+    print("image file id")
+    measure("json string", LegacyJson(), FILE_ID)
+    measure("raw string", StringCodec(), FILE_ID)
+
+    url = os.environ.get("BENCH_REDIS_URL")
+    client = redis.Redis.from_url(url) if url else None
+    source = "MEMORY USAGE" if client else "modelled"
+
+    print(f"paid flag memory, {USERS} paid users ({source}, shard 2^{PAID_SHARD_BITS})")
+    for label, client_ids in get_id_sets().items():
+        print(f"  {label}")
+        for layout, keys in build_layouts(client_ids).items():
+            size = (
+                measure_size(client, layout, keys)
+                if client
+                else model_size(layout, keys)
+            )
+            print(
+                f"    {layout:<14} {len(keys):>6} keys  "
+                f"{size / 1024:9.1f} KiB  {size / USERS:8.1f} bytes/user"
+            )
+
+
+if __name__ == "__main__":
+    main()
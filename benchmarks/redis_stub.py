@@ -0,0 +1,228 @@
+"""Minimal in-memory RESP2 server used by the Redis benchmarks.
+
+It keeps strings, bitmaps, sets and hashes per logical database and counts connections,
+round trips (request batches read from a socket) and commands, which is
+what the benchmarks compare. Expiry is ignored and Lua is not executed: EVAL/EVALSHA answer with
+whatever `script_handler(keys, args)` returns. It is not a Redis replacement.
+"""
+
+import asyncio
+import fnmatch
+
+
+class Raw(bytes):
+    pass
+
+
+class Status:
+    def __init__(self, text: bytes):
+        self.text = text
+
+
+OK = Status(b"OK")
+QUEUED = Status(b"QUEUED")
+PONG = Status(b"PONG")
+
+
+def encode(value) -> bytes:
+    if isinstance(value, Raw):
+        return bytes(value)
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, Status):
+        return b"+%s\r\n" % value.text
+    if isinstance(value, (list, tuple)):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def parse_commands(buffer: bytearray) -> list:
+    commands = list()
+    position = 0
+
+    while position < len(buffer):
+        end = buffer.find(b"\r\n", position)
+        if end == -1 or buffer[position : position + 1] != b"*":
+            break
+        count = int(buffer[position + 1 : end])
+        cursor = end + 2
+        arguments = list()
+
+        for _ in range(count):
+            end = buffer.find(b"\r\n", cursor)
+            if end == -1:
+                break
+            length = int(buffer[cursor + 1 : end])
+            if len(buffer) < end + 2 + length + 2:
+                break
+            arguments.append(bytes(buffer[end + 2 : end + 2 + length]))
+            cursor = end + 2 + length + 2
+
+        if len(arguments) < count:
+            break
+        commands.append(arguments)
+        position = cursor
+
+    del buffer[:position]
+    return commands
+
+
+class RedisStub:
+    def __init__(self):
+        self.databases = dict()
+        self.connections = 0
+        self.round_trips = 0
+        self.commands = 0
+        self.script_handler = None
+        self.server = None
+        self.port = None
+
+    def reset_counters(self):
+        self.connections = self.round_trips = self.commands = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        state = {"db": 0, "queue": None}
+        buffer = bytearray()
+
+        try:
+            while data := await reader.read(1 << 16):
+                buffer += data
+                commands = parse_commands(buffer)
+                if not commands:
+                    continue
+                self.round_trips += 1
+                writer.write(b"".join(self.run(state, command) for command in commands))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def run(self, state: dict, command: list) -> bytes:
+        self.commands += 1
+        name = command[0].upper()
+
+        if name == b"MULTI":
+            state["queue"] = list()
+            return encode(OK)
+        if name == b"EXEC":
+            queue, state["queue"] = state["queue"] or [], None
+            return encode([Raw(self.execute(state, item)) for item in queue])
+        if state["queue"] is not None:
+            state["queue"].append(command)
+            return encode(QUEUED)
+        return self.execute(state, command)
+
+    def execute(self, state: dict, command: list) -> bytes:
+        name, arguments = command[0].upper(), command[1:]
+        data = self.databases.setdefault(state["db"], dict())
+
+        if name == b"SELECT":
+            state["db"] = int(arguments[0])
+            return encode(OK)
+        if name == b"PING":
+            return encode(PONG)
+        if name == b"SET":
+            data[arguments[0]] = arguments[1]
+            return encode(OK)
+        if name == b"GET":
+            value = data.get(arguments[0])
+            return encode(value if isinstance(value, bytes) else None)
+        if name == b"MGET":
+            values = [data.get(key) for key in arguments]
+            return encode(
+                [value if isinstance(value, bytes) else None for value in values]
+            )
+        if name == b"SCAN":
+            options = dict(zip(arguments[1::2], arguments[2::2]))
+            options = {key.upper(): value for key, value in options.items()}
+            pattern = options.get(b"MATCH", b"*").decode()
+            kind = {b"STRING": (bytes, bytearray), b"HASH": dict}.get(
+                options.get(b"TYPE", b"").upper(), object
+            )
+            keys = [
+                key
+                for key, value in data.items()
+                if isinstance(value, kind)
+                and fnmatch.fnmatchcase(key.decode(), pattern)
+            ]
+            return encode([b"0", keys])
+        if name == b"HSETNX":
+            fields = data.setdefault(arguments[0], dict())
+            if arguments[1] in fields:
+                return encode(0)
+            fields[arguments[1]] = arguments[2]
+            return encode(1)
+        if name == b"DEL":
+            return encode(sum(data.pop(key, None) is not None for key in arguments))
+        if name == b"HSET":
+            fields = data.setdefault(arguments[0], dict())
+            pairs = list(zip(arguments[1::2], arguments[2::2]))
+            added = sum(field not in fields for field, _ in pairs)
+            fields.update(pairs)
+            return encode(added)
+        if name == b"HDEL":
+            fields = data.get(arguments[0], dict())
+            return encode(
+                sum(fields.pop(key, None) is not None for key in arguments[1:])
+            )
+        if name == b"HGET":
+            return encode(data.get(arguments[0], dict()).get(arguments[1]))
+        if name == b"HMGET":
+            fields = data.get(arguments[0], dict())
+            return encode([fields.get(field) for field in arguments[1:]])
+        if name == b"EXISTS":
+            return encode(sum(key in data for key in arguments))
+        if name == b"SETBIT":
+            bits = data.setdefault(arguments[0], bytearray())
+            offset, value = int(arguments[1]), int(arguments[2])
+            if len(bits) <= offset // 8:
+                bits.extend(bytes(offset // 8 + 1 - len(bits)))
+            mask = 0x80 >> (offset % 8)
+            previous = int(bool(bits[offset // 8] & mask))
+            bits[offset // 8] = (
+                bits[offset // 8] | mask if value else bits[offset // 8] & ~mask
+            )
+            return encode(previous)
+        if name == b"GETBIT":
+            bits, offset = data.get(arguments[0], bytearray()), int(arguments[1])
+            return encode(
+                int(
+                    offset // 8 < len(bits)
+                    and bool(bits[offset // 8] & 0x80 >> offset % 8)
+                )
+            )
+        if name == b"BITCOUNT":
+            return encode(
+                sum(bin(byte).count("1") for byte in data.get(arguments[0], b""))
+            )
+        if name == b"SADD":
+            members = data.setdefault(arguments[0], set())
+            added = len(set(arguments[1:]) - members)
+            members.update(arguments[1:])
+            return encode(added)
+        if name == b"SMEMBERS":
+            return encode(list(data.get(arguments[0], set())))
+        if name == b"HGETALL":
+            fields = data.get(arguments[0], dict())
+            return encode([item for pair in fields.items() for item in pair])
+        if name == b"PUBLISH":
+            return encode(0)
+        if name in (b"EVAL", b"EVALSHA"):
+            count = int(arguments[1])
+            keys, args = arguments[2 : 2 + count], arguments[2 + count :]
+            handler = self.script_handler
+            return encode(handler(keys, args) if handler else None)
+        return encode(OK)
@@ -0,0 +1,103 @@
+"""Compare per-click CPU of building keyboards on every click with render plans.
+
+Run from the repository root: python -m benchmarks.render_plan
+"""
+
+import asyncio
+import time
+
+from aiogram import types
+
+from bot.messages.message_node import MessageNode, RootNode
+from bot.messages.image_cache import image_cache
+from bot.messages.message_tree import get_callback_data
+from bot.messages.render import render_node
+
+CLICKS = 20_000
+CHOICES = 8
+
+
+class FakeMessage:
+    async def answer(self, text, **kwargs):
+        return None
+
+    async def answer_photo(self, photo, **kwargs):
+        return None
+
+
+def build_tree():
+    root = RootNode("Welcome\\!", "Start", version="v")
+    position = 0
+    for index in range(1, CHOICES + 1):
+        position += 1
+        node = MessageNode(
+            f"Answer {index}\\.",
+            f"Option {index}",
+            f"/images/{index}.jpg",
+            str(index),
+            position,
+        )
+        root.add_node(str(index), node)
+        image_cache.file_ids[str(index)] = f"file-id-{index}"
+        for child in range(1, CHOICES + 1):
+            position += 1
+            leaf = MessageNode(
+                f"Leaf {child}", f"Leaf option {child}", position=position
+            )
+            root.add_node(f"{index}.{child}", leaf)
+    return root
+
+
+async def legacy_render(message, node):
+    button_list = []
+    for choice in node.choices:
+        button_list.append(
+            [
+                types.InlineKeyboardButton(
+                    text=choice.short_text,
+                    callback_data=get_callback_data("v", choice.position),
+                )
+            ]
+        )
+    reply_markup = types.InlineKeyboardMarkup(inline_keyboard=button_list)
+    await message.answer(node.short_text, protect_content=True)
+    if node.image:
+        file_id = image_cache.file_ids.get(node.image_hash)
+        if node.text:
+            await message.answer_photo(file_id, protect_content=True)
+            await message.answer(
+                node.text,
+                reply_markup=reply_markup,
+                parse_mode="MarkdownV2",
+                protect_content=True,
+            )
+        else:
+            await message.answer_photo(file_id, reply_markup=reply_markup)
+    elif node.text:
+        await message.answer(
+            node.text,
+            reply_markup=reply_markup,
+            parse_mode="MarkdownV2",
+            protect_content=True,
+        )
+
+
+async def measure(label, render, nodes):
+    message = FakeMessage()
+    started = time.process_time()
+    for click in range(CLICKS):
+        await render(message, nodes[click % len(nodes)])
+    elapsed = time.process_time() - started
+    print(f"{label:>8}: {elapsed * 1e6 / CLICKS:7.1f} us CPU/click")
+
+
+async def main():
+    root = build_tree()
+    nodes = list(root.choices)
+    print(f"{CLICKS} clicks over {len(nodes)} nodes with {CHOICES} buttons each")
+    await measure("legacy", legacy_render, nodes)
+    await measure("plan", render_node, nodes)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""Compare storage backend overhead on the bot's payment flows.
+
+Each flow runs against a PaymentManager bound to a given client:
+
+* memory - the in-process engine (DB_BACKEND=memory), no sockets at all;
+* stub   - redis-py over a real socket to the in-process RESP stub, so the
+           difference to memory is client and protocol overhead. The stub does
+           not run Lua, payment scripts answer with a canned reply;
+* redis  - a real server, only when BENCH_REDIS_URL is set. The benchmark
+           writes users:/payments: keys there, point it at a scratch database.
+
+The payment info cache is disabled so that every session check reaches the
+backend.
+
+Run from the repository root: python -m benchmarks.storage_backends
+"""
+
+import asyncio
+import os
+import time
+
+from redis import asyncio as aioredis
+
+from benchmarks.redis_stub import RedisStub
+
+USERS = 2_000
+CONCURRENCY = 20
+CONFIRMATION_URL = "https://yoomoney.ru/checkout/payments/v2/contract?orderId=x"
+
+
+async def check_payment(manager, index: int):
+    await manager.users.get_session(str(index))
+
+
+async def webhook(manager, index: int):
+    payment_id = f"webhook-{index}"
+    await manager.create_payment(str(index), payment_id, CONFIRMATION_URL)
+    await manager.confirm_payment(payment_id)
+
+
+async def gift(manager, index: int):
+    from db.redis.client import UserState
+
+    client_id, target_user = str(index), str(-index - 1)
+    await manager.users.set_state(client_id, UserState.GIVE_BOT)
+    await manager.users.get_session(client_id)
+    await manager.users.get_session(target_user)
+    await manager.create_payment(
+        client_id, f"gift-{index}", CONFIRMATION_URL, target_user=target_user
+    )
+    await manager.users.set_state(client_id, UserState.NONE)
+
+
+FLOWS = {"check_payment": check_payment, "webhook": webhook, "gift": gift}
+
+
+async def run_flow(manager, flow) -> float:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def run(index: int):
+        async with semaphore:
+            await flow(manager, index)
+
+    await run(USERS)
+    started = time.perf_counter()
+    await asyncio.gather(*(run(index) for index in range(USERS)))
+    return (time.perf_counter() - started) / USERS
+
+
+async def run_backend(label: str, client):
+    from db.redis.cache import PaymentInfoCache
+    from db.redis.client import PaymentManager
+
+    manager = PaymentManager(client)
+    manager.users.cache = PaymentInfoCache(0, 0)
+    await manager.load_scripts()
+
+    timings = [await run_flow(manager, flow) for flow in FLOWS.values()]
+    print(
+        f"{label:<8}"
+        + "".join(f"{elapsed * 1e6:>16.1f}" for elapsed in timings)
+        + "  us/flow"
+    )
+
+
+async def main():
+    stub = await RedisStub().start()
+    stub.script_handler = lambda keys, args: [1, b"", b"", b"", b""]
+    os.environ["DB_HOST"] = "127.0.0.1"
+    os.environ["DB_PORT"] = str(stub.port)
+    os.environ.pop("DB_USER", None)
+    os.environ.pop("DB_PASSWORD", None)
+
+    from db.redis.client import create_client
+
+    print(f"{USERS} users, {CONCURRENCY} concurrent")
+    print(f"{'backend':<8}" + "".join(f"{name:>16}" for name in FLOWS))
+
+    await run_backend("memory", create_client("memory"))
+
+    client = create_client("redis")
+    await run_backend("stub", client)
+    await client.aclose()
+    await client.connection_pool.disconnect()
+
+    url = os.environ.get("BENCH_REDIS_URL")
+    if url:
+        client = aioredis.from_url(url, decode_responses=True)
+        await run_backend("redis", client)
+        await client.aclose()
+
+    await stub.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
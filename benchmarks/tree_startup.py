@@ -0,0 +1,61 @@
+"""Compare a full tree parse with loading the precompiled snapshot.
+
+Run from the repository root: python -m benchmarks.tree_startup
+"""
+
+import os
+import tempfile
+import time
+
+from PIL import Image
+
+from benchmarks.node_memory import generate_rows
+
+IMAGES = 50
+
+
+def write_tree(directory: str, rows) -> str:
+    tree_path = os.path.join(directory, "tree.txt")
+    with open(tree_path, "w", encoding="utf-8") as file:
+        file.write("0|Welcome (root)!|Start|\n")
+        for node_id, text, short_text, image in rows:
+            image_name = os.path.splitext(os.path.basename(image))[0] if image else ""
+            file.write(
+                f"{node_id}|{text}. See https://example.com/a_b|{short_text}|{image_name}\n"
+            )
+    return tree_path
+
+
+def write_images(directory: str):
+    for index in range(IMAGES):
+        Image.new("RGB", (800, 600), (index * 5, 100, 150)).save(
+            os.path.join(directory, f"{index}.jpg"), quality=90
+        )
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ["IMAGES_PATH"] = directory
+        write_images(directory)
+
+        from bot.messages.parsing.parser import load_message_tree, parse_message_tree
+
+        rows = generate_rows()
+        tree_path = write_tree(directory, rows)
+        print(f"{len(rows)} nodes, {IMAGES} images")
+
+        started = time.perf_counter()
+        parse_message_tree(tree_path)
+        print(f"   parse: {time.perf_counter() - started:7.3f} s")
+
+        started = time.perf_counter()
+        load_message_tree(tree_path)
+        print(f"   parse + snapshot write: {time.perf_counter() - started:7.3f} s")
+
+        started = time.perf_counter()
+        load_message_tree(tree_path)
+        print(f"   snapshot load: {time.perf_counter() - started:7.3f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,33 @@
+import asyncio
 import logging
 import os
 
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters.command import Command
-from aiogram.types import FSInputFile
-from aiogram.types import InlineKeyboardMarkup
 from dotenv import load_dotenv
-from db.redis.client import payments, add_priveleged_users, user_states, UserState
+from db.redis.client import (
+    payments,
+    add_priveleged_users,
+    UserState,
+    trees,
+    TREE_CHANNEL,
+    convert_legacy_records,
+    payment_events,
+)
 from payment.client import create_payment
 from aiogram.types import ContentType
-from bot.setup import handle_text_file
+from bot.setup import (
+    get_import_report,
+    handle_text_file,
+    handle_users_file,
+    load_published_tree,
+    publish_local_tree,
+    publish_tree,
+)
+from bot.messages.image_cache import image_cache
+from bot.messages.render import render_node
 from bot.messages.parsing.parser import prepare_text
+from bot.session import SessionMiddleware
 from aiogram.filters import Filter
 
 load_dotenv()
@@ -23,41 +40,41 @@ ADMINS = [int(id) for id in os.environ.get("ADMINS").split(",")]
 enable_setup = os.environ.get("SETUP_ENABLE", "False").lower() == "true"
 enable_payments = os.environ.get("PAYMENT_ENABLE", "True").lower() == "true"
 greeting_text = prepare_text(os.environ.get("GREETING", ""))
+images_chat_id = os.environ.get("IMAGES_CACHE_CHAT_ID")
+enable_webhook = os.environ.get("BOT_WEBHOOK_ENABLE", "False").lower() == "true"
+webhook_url = os.environ.get("BOT_WEBHOOK_URL")
+webhook_secret = os.environ.get("BOT_WEBHOOK_SECRET") or None
+background_tasks = set()
+messages_tree = None
 
+session_middleware = SessionMiddleware(payments.users, enabled=enable_payments)
+dp.message.outer_middleware(session_middleware)
+dp.callback_query.outer_middleware(session_middleware)
 
-class GiveBotFilter(Filter):
-    async def __call__(self, message: types.Message) -> bool:
-        return await check_user_gives_bot(message)
 
+class GiveBotFilter(Filter):
+    async def __call__(self, message: types.Message, user_session: dict) -> bool:
+        return check_user_gives_bot(user_session)
 
-def get_keyboard_from_choices(choices):
-    button_list = []
-    for choice, node in choices.items():
-        button_list.append(
-            [
-                types.InlineKeyboardButton(
-                    text=node.short_text, callback_data=nodes_ids.get(choice)
-                )
-            ]
-        )
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=button_list)
-    return reply_markup
 
 async def check_payment_by_user_id(client_id: str) -> bool:
-    payment_info = await payments.users.get_payment_info(client_id)
-    paid = payment_info.get("paid", False)
+    session = await payments.users.get_session(client_id)
+    paid = session.get("paid", False)
     
     return paid 
     
-async def check_payment(message: types.Message) -> bool:
+async def check_payment(message: types.Message, session: dict) -> bool:
 
     if not enable_payments:
         return True
 
+    if session is None:
+        await failure_create_payment_message(message)
+        return False
+
     client_id = str(message.chat.id)
-    payment_info = await payments.users.get_payment_info(client_id)
-    paid = payment_info.get("paid", False)
-    confirmation_url = payment_info.get("confirmation_url", False)
+    paid = session["paid"]
+    confirmation_url = session["confirmation_url"]
 
     if not paid and not confirmation_url:
         confirmation_url = await create_payment(client_id)
@@ -72,51 +89,35 @@ async def check_payment(message: types.Message) -> bool:
     return paid
 
 
-async def check_user_gives_bot(message: types.Message) -> bool:
+def check_user_gives_bot(session: dict) -> bool:
 
-    if not enable_payments:
+    if not enable_payments or session is None:
         return False
 
-    return await user_states.check_state(message.chat.id, UserState.GIVE_BOT)
+    return session["state"] == UserState.GIVE_BOT.value
 
 
 @dp.callback_query(lambda c: True)
-async def handle_callback_query(call: types.CallbackQuery):
+async def handle_callback_query(call: types.CallbackQuery, user_session: dict):
     try:
         message = call.message
 
-        payment_check_result = await check_payment(message)
+        node = messages_tree.get_node_by_callback(call.data)
+
+        if not node:
+            await call.answer(
+                text="Меню устарело, пожалуйста, нажмите /start", show_alert=True
+            )
+            return
+
+        payment_check_result = await check_payment(message, user_session)
 
         if not payment_check_result:
             return
 
         await call.answer()
 
-        node_id = nodes_ids.get(call.data)
-        node = messages_tree.get_node(node_id)
-
-        if node:
-            reply_markup = get_keyboard_from_choices(node.choices)
-            await call.message.answer(node.short_text, protect_content=True)
-            if node.image:
-                image = FSInputFile(node.image)
-                if node.text:
-                    await call.message.answer_photo(image, protect_content=True)
-                    await call.message.answer(
-                        node.text,
-                        reply_markup=reply_markup,
-                        parse_mode="MarkdownV2",
-                        protect_content=True,
-                    )
-                else:
-                    await call.message.answer_photo(image, reply_markup=reply_markup)
-            elif node.text:
-                await call.message.answer(
-                    node.text,
-                    reply_markup=reply_markup,
-                    parse_mode="MarkdownV2",
-                    protect_content=True,
-                )
+        await render_node(call.message, node)
     except Exception as e:
         logging.error(f"Error handling callback query: {e}")
         await call.answer(
@@ -152,15 +153,24 @@ async def handle_document(message: types.Message):
 
     file_extension = os.path.splitext(document.file_name)[1].lower()
 
-    global messages_tree, nodes_ids
+    global messages_tree
 
     if file_extension == ".txt":
-        result = await handle_text_file(bot, message, file_path)
+        result = await handle_text_file(bot, message, file_path, messages_tree)
         if result:
-            messages_tree, nodes_ids = result
+            messages_tree, content = result
+            await message.reply("Новое дерево диалога применено", protect_content=True)
+            await publish_tree(bot, message, messages_tree, content)
+            run_background(
+                image_cache.prewarm(
+                    bot, images_chat_id or message.chat.id, messages_tree
+                )
+            )
+    elif file_extension == ".csv":
+        await handle_users_file(bot, message, file_path)
     else:
         await message.reply(
-            "Пожалуйста, отправьте файл формата txt", protect_content=True
+            "Пожалуйста, отправьте файл формата txt или csv", protect_content=True
         )
 
 
@@ -181,13 +191,38 @@ async def handle_admin_commands(message: types.Message):
             arguments = cmd[1:]
 
         ids = {int(arg) for arg in arguments}
-        await add_priveleged_users(ids)
-        await message.reply(f'Пользователи успешно добавлены: {", ".join(arguments)}')
+        counts = await add_priveleged_users(ids)
+        await message.reply(
+            f'Пользователи добавлены: {", ".join(arguments)}\n'
+            + get_import_report(counts)
+        )
 
     except Exception as e:
         await message.reply(f"Ошибка выполнения команды")
 
 
+@dp.message(Command("stats"))
+async def send_stats(message: types.Message):
+
+    if not enable_setup:
+        return
+
+    user_id = message.from_user.id
+    if user_id not in ADMINS:
+        return
+
+    stats = payments.users.cache.stats()
+    paid_users = await payments.users.count_paid()
+    dead_events = await payment_events.count_dead()
+    await message.reply(
+        f"Оплативших пользователей: {paid_users}\n"
+        f"Необработанных уведомлений об оплате: {dead_events}\n"
+        f"Кэш оплат: записей {stats['size']}, попаданий {stats['hits']}, "
+        f"промахов {stats['misses']}, инвалидаций {stats['invalidations']}, "
+        f"доля попаданий {stats['hit_rate']:.1%}"
+    )
+
+
 @dp.message(Command("id"))
 async def send_client_id(message: types.Message):
     await bot.send_message(message.chat.id, f"Your ID: {message.from_user.id}")
@@ -195,7 +230,7 @@ async def send_client_id(message: types.Message):
 
 @dp.message(Command("gift"))
 async def give_bot(message: types.Message):
-    access = await user_states.set_state(message.chat.id, UserState.GIVE_BOT)
+    access = await payments.users.set_state(message.chat.id, UserState.GIVE_BOT)
 
     if access:
         await message.reply(
@@ -219,7 +254,7 @@ async def handle_give_bot_response(message: types.Message):
         )
         if not confirmation_url:
             await failure_create_payment_message(message)
-        await user_states.set_state(message.chat.id, UserState.NONE)
+        await payments.users.set_state(message.chat.id, UserState.NONE)
         await confirm_create_payment(message, confirmation_url, greeting=False)
     except ValueError:
         await message.reply(
@@ -228,37 +263,16 @@ async def handle_give_bot_response(message: types.Message):
 
 
 @dp.message(Command("start"))
-async def entrypoint(message: types.Message):
+async def entrypoint(message: types.Message, user_session: dict):
 
-    payment_check_result = await check_payment(message)
+    payment_check_result = await check_payment(message, user_session)
 
     if not payment_check_result:
         return
 
-    node = messages_tree
+    node = messages_tree.root
     if node:
-        reply_markup = get_keyboard_from_choices(node.choices)
-        if node.image:
-            image = FSInputFile(node.image)
-            if node.text:
-                await message.answer_photo(image, protect_content=True)
-                await message.answer(
-                    node.text,
-                    reply_markup=reply_markup,
-                    parse_mode="MarkdownV2",
-                    protect_content=True,
-                )
-            else:
-                await message.answer_photo(
-                    image, reply_markup=reply_markup, protect_content=True
-                )
-        elif node.text:
-            await message.answer(
-                node.text,
-                reply_markup=reply_markup,
-                parse_mode="MarkdownV2",
-                protect_content=True,
-            )
+        return await render_node(message, node, reply=True)
 
 
 async def confirm_create_payment(
@@ -311,13 +325,63 @@ async def failure_create_payment_message(message: types.Message):
     )
 
 
+def run_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def install_tree_version(version: str = None):
+
+    global messages_tree
+
+    if version and messages_tree and version == messages_tree.version:
+        return
+
+    result = await load_published_tree(messages_tree)
+    if result and (not messages_tree or result.version != messages_tree.version):
+        messages_tree = result
+        logging.info(f"Tree version {result.version} installed")
+
+
 async def start_bot():
 
-    global messages_tree, nodes_ids
+    global messages_tree
 
-    from bot.messages.parsing.parser import parse_message_tree
+    if enable_webhook and not webhook_secret:
+        raise SystemExit("BOT_WEBHOOK_SECRET is required when BOT_WEBHOOK_ENABLE=true")
+
+    from bot.messages.parsing.parser import load_message_tree
 
     tree_path = os.environ.get("TREE_PATH")
-    messages_tree, nodes_ids = parse_message_tree(tree_path)
+    messages_tree = load_message_tree(tree_path)
+
+    try:
+        if not await publish_local_tree(messages_tree):
+            await install_tree_version()
+    except Exception as e:
+        logging.error(f"Published tree sync error: {e}")
+
+    run_background(
+        trees.listen(
+            TREE_CHANNEL,
+            install_tree_version,
+            on_subscribe=install_tree_version,
+        )
+    )
+
+    if enable_payments:
+        run_background(payments.users.listen_invalidations())
+
+    run_background(convert_legacy_records())
+
+    if enable_webhook:
+        await bot.set_webhook(
+            webhook_url,
+            secret_token=webhook_secret,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        return
 
+    await bot.delete_webhook()
     await dp.start_polling(bot)
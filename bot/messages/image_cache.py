@@ -0,0 +1,99 @@
+import asyncio
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import FSInputFile
+from db.redis.client import image_files
+from bot.messages.message_tree import MessageTree
+from logger_config import logger
+
+PREWARM_DELAY = 1
+FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference expired",
+    "file_reference_expired",
+)
+
+
+def is_file_id_error(error: TelegramBadRequest) -> bool:
+    message = error.message.lower()
+    return any(reason in message for reason in FILE_ID_ERRORS)
+
+
+class ImageCache:
+    def __init__(self, database):
+        self.database = database
+        self.file_ids = dict()
+
+    async def get_file_id(self, image_hash: str):
+        if not image_hash:
+            return
+
+        file_id = self.file_ids.get(image_hash)
+        if file_id is None:
+            file_id = await self.database.get_file_id(image_hash)
+            if file_id:
+                self.file_ids[image_hash] = file_id
+        return file_id
+
+    async def remember(self, image_hash: str, message):
+        if not image_hash or not message or not message.photo:
+            return
+
+        file_id = message.photo[-1].file_id
+        if self.file_ids.get(image_hash) != file_id:
+            self.file_ids[image_hash] = file_id
+            await self.database.set_file_id(image_hash, file_id)
+
+    async def forget(self, image_hash: str):
+        self.file_ids.pop(image_hash, None)
+        await self.database.delete(image_hash)
+
+    async def answer_photo(self, message, node, **kwargs):
+        file_id = await self.get_file_id(node.image_hash)
+
+        if file_id:
+            try:
+                return await message.answer_photo(file_id, **kwargs)
+            except TelegramBadRequest as e:
+                if not is_file_id_error(e):
+                    raise
+                logger.warning(f"Cached file id for {node.image} rejected: {e}")
+                await self.forget(node.image_hash)
+
+        sent = await message.answer_photo(FSInputFile(node.image), **kwargs)
+        await self.remember(node.image_hash, sent)
+        return sent
+
+    async def upload(self, bot, chat_id: int, image_path: str):
+        while True:
+            try:
+                return await bot.send_photo(
+                    chat_id, FSInputFile(image_path), disable_notification=True
+                )
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+
+    async def prewarm(self, bot, chat_id: int, tree: MessageTree):
+        images = {node.image_hash: node.image for node in tree.nodes if node.image}
+        uploaded = 0
+
+        for image_hash, image_path in images.items():
+            try:
+                if await self.get_file_id(image_hash):
+                    continue
+
+                sent = await self.upload(bot, chat_id, image_path)
+                await self.remember(image_hash, sent)
+                await bot.delete_message(chat_id, sent.message_id)
+                uploaded += 1
+            except Exception as e:
+                logger.error(f"Prewarm image {image_path} error: {e}", exc_info=True)
+
+            await asyncio.sleep(PREWARM_DELAY)
+
+        logger.info(
+            f"Prewarmed {uploaded} of {len(images)} images for tree {tree.version}"
+        )
+
+
+image_cache = ImageCache(image_files)
@@ -1,35 +1,81 @@
+import sys
+
+EMPTY_CHOICES = ()
+
+
 class MessageNode:
-    def __init__(self, text: str, short_text: str, image: str = None):
+    __slots__ = (
+        "text",
+        "image",
+        "image_hash",
+        "short_text",
+        "choices",
+        "parent",
+        "position",
+        "render_plan",
+    )
+
+    def __init__(
+        self,
+        text: str,
+        short_text: str,
+        image: str = None,
+        image_hash: str = None,
+        position: int = 0,
+    ):
         self.text = text
-        self.image = image
+        self.image = sys.intern(image) if image else image
+        self.image_hash = sys.intern(image_hash) if image_hash else image_hash
         self.short_text = short_text
-        self.choices = dict()
+        self.choices = EMPTY_CHOICES
+        self.parent = None
+        self.position = position
+        self.render_plan = None
 
-    def add_node(self, node_id, node, current=0):
+    def get_root(self) -> "RootNode":
+        node = self
+        while node.parent is not None:
+            node = node.parent
+        return node
 
-        if isinstance(node_id, str):
-            node_id = node_id.split(".")
 
-        if current == len(node_id) - 1:
-            node_id = ".".join(node_id)
-            self.choices[node_id] = node
-            return
+class RootNode(MessageNode):
+    __slots__ = ("index", "version")
 
-        self.choices.get(".".join(node_id[: current + 1])).add_node(
-            node_id, node, current + 1
-        )
+    def __init__(
+        self,
+        text: str,
+        short_text: str,
+        image: str = None,
+        image_hash: str = None,
+        version: str = None,
+    ):
+        super().__init__(text, short_text, image, image_hash)
+        self.index = dict()
+        self.version = version
 
-    def get_node(self, node_id, current=0):
+    def add_node(self, node_id: str, node: MessageNode):
 
-        if not node_id:
-            return
+        self.link_node(node_id, node)
+        self.index[node_id] = node
 
-        if isinstance(node_id, str):
-            node_id = node_id.split(".")
+    def link_node(self, node_id: str, node: MessageNode):
 
-        if current == len(node_id) - 1:
-            return self.choices.get(".".join(node_id), None)
+        separator = node_id.rfind(".")
+        parent = self.index.get(node_id[:separator]) if separator != -1 else self
+
+        if parent is None:
+            raise KeyError(f"Parent node for {node_id} is not found")
+
+        if parent.choices is EMPTY_CHOICES:
+            parent.choices = []
+
+        parent.choices.append(node)
+        node.parent = parent
+
+    def get_node(self, node_id: str):
+
+        if not node_id:
+            return
 
-        return self.choices.get(".".join(node_id[: current + 1])).get_node(
-            node_id, current + 1
-        )
+        return self.index.get(node_id)
@@ -0,0 +1,66 @@
+from bot.messages.message_node import MessageNode
+
+ALPHABET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+ALPHABET_INDEX = {char: value for value, char in enumerate(ALPHABET)}
+VERSION_SEPARATOR = ":"
+
+
+def encode_number(number: int) -> str:
+    if number == 0:
+        return ALPHABET[0]
+
+    chars = []
+    while number:
+        number, remainder = divmod(number, len(ALPHABET))
+        chars.append(ALPHABET[remainder])
+    return "".join(reversed(chars))
+
+
+def decode_number(value: str) -> int:
+    number = 0
+    for char in value:
+        number = number * len(ALPHABET) + ALPHABET_INDEX[char]
+    return number
+
+
+def get_tree_version(source_hash: bytes) -> str:
+    return encode_number(int.from_bytes(source_hash[:4], "big"))
+
+
+def get_callback_data(version: str, position: int) -> str:
+    return f"{version}{VERSION_SEPARATOR}{encode_number(position)}"
+
+
+class MessageTree:
+    __slots__ = ("root", "nodes", "version", "records", "images")
+
+    def __init__(
+        self,
+        root: MessageNode,
+        nodes: list,
+        version: str,
+        records: list,
+        images: dict,
+    ):
+        self.root = root
+        self.nodes = nodes
+        self.version = version
+        self.records = records
+        self.images = images
+
+    def get_node(self, node_id: str):
+        return self.root.get_node(node_id)
+
+    def get_node_by_callback(self, callback_data: str):
+        version, _, position = (callback_data or "").partition(VERSION_SEPARATOR)
+
+        if version != self.version or not position:
+            return
+
+        try:
+            position = decode_number(position)
+        except KeyError:
+            return
+
+        if 0 < position < len(self.nodes):
+            return self.nodes[position]
@@ -1,59 +1,231 @@
-from bot.messages.message_node import MessageNode
-from utils.image_utils import prepare_image, get_image_path
+from bot.messages.message_node import MessageNode, RootNode
+from bot.messages.message_tree import MessageTree, get_tree_version
+from bot.messages.parsing.snapshot import get_file_hash, load_snapshot, write_snapshot
+from utils.image_utils import (
+    IMAGES_WORKERS,
+    get_image_hash,
+    get_image_path,
+    prepare_image,
+)
+from concurrent.futures import ProcessPoolExecutor
 import hashlib
+import io
+import os
 import re
 
-nodes_ids = dict()
+CHUNK_SIZE = 1 << 20
+URL_UNDERSCORE = re.compile(r"(https?://\S+)_")
+NO_IMAGE = (None, None, None)
 
 
-def get_hash(input_string: str, algorithm: str = "sha256") -> str:
-    hash_function = hashlib.new(algorithm)
-    hash_function.update(input_string.encode("utf-8"))
-    return hash_function.hexdigest()
+class TreeParseError(ValueError):
+    def __init__(self, line_number: int, reason: str):
+        super().__init__(f"Line {line_number}: {reason}" if line_number else reason)
+        self.line_number = line_number
+        self.reason = reason
+
+    def __reduce__(self):
+        return type(self), (self.line_number, self.reason)
+
+
+def escape_url_underscore(match: re.Match) -> str:
+    return match.group(1) + r"\_"
 
 
 def prepare_text(text: str):
+    text = text.strip()
+    if r"\n" in text:
+        text = text.replace(r"\n", "\n")
     text = (
-        text.strip()
-        .replace("\\n", "\n")
-        .replace(".", "\.")
-        .replace("!", "\!")
-        .replace("#", "\#")
-        .replace("+", "\+")
-        .replace("=", "\=")
-        .replace("-", "\-")
-        .replace("(", "\(")
-        .replace(")", "\)")
+        text.replace(".", r"\.")
+        .replace("!", r"\!")
+        .replace("#", r"\#")
+        .replace("+", r"\+")
+        .replace("=", r"\=")
+        .replace("-", r"\-")
+        .replace("(", r"\(")
+        .replace(")", r"\)")
     )
-    text = re.sub(r"(https?://\S+)_", r"\1\\_", text)
+    if "://" in text:
+        text = URL_UNDERSCORE.sub(escape_url_underscore, text)
 
     return text
 
 
-def parse_message_tree(file_path: str):
-    messages_tree = None
+def iter_lines(file, chunk_size: int = CHUNK_SIZE):
+    tail = ""
+    for chunk in iter(lambda: file.read(chunk_size), ""):
+        lines = (tail + chunk).split("\n")
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def get_line_hash(line: str) -> bytes:
+    return hashlib.blake2b(line.encode("utf-8"), digest_size=8).digest()
+
+
+def iter_message_records(lines, previous: dict):
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+
+        line_hash = get_line_hash(line)
+        parts = line.split("|")
+        if len(parts) < 4:
+            raise TreeParseError(
+                line_number, f"expected 4 fields separated by '|', got {len(parts)}"
+            )
+
+        node_id = parts[0].strip()
+        if not node_id:
+            raise TreeParseError(line_number, "node id is empty")
+
+        record = previous.get(node_id)
+        if record and record[0] == line_hash:
+            yield line_number, record
+            continue
+
+        text = prepare_text(parts[1])
+        short_text = parts[2].strip()
+        image_name = parts[3].strip()
+        image_source = get_image_path(image_name) if image_name else None
+
+        yield line_number, (line_hash, node_id, text, short_text, image_source)
+
+
+def parse_message_lines(lines, previous_records: list = None):
+    previous = {record[1]: record for record in previous_records or ()}
+    records = []
+    line_numbers = dict()
+
+    for line_number, record in iter_message_records(lines, previous):
+        node_id = record[1]
+        if node_id in line_numbers:
+            raise TreeParseError(
+                line_number,
+                f"node {node_id} is already defined on line {line_numbers[node_id]}",
+            )
+        line_numbers[node_id] = line_number
+        records.append(record)
+
+    if not records:
+        raise TreeParseError(None, "tree is empty")
+
+    root_id = records[0][1]
+    for _, node_id, *_ in records[1:]:
+        separator = node_id.rfind(".")
+        parent_id = node_id[:separator]
+        if separator != -1 and (parent_id == root_id or parent_id not in line_numbers):
+            raise TreeParseError(
+                line_numbers[node_id], f"parent of node {node_id} is not defined"
+            )
+
+    return records
+
+
+def parse_message_text(content: bytes, previous_records: list = None):
+    return parse_message_lines(
+        iter_lines(io.StringIO(content.decode("utf-8"))), previous_records
+    )
+
+
+def collect_images(records):
+    return sorted({record[-1] for record in records if record[-1]})
+
+
+def get_image_signature(image_source: str):
+    stat = os.stat(image_source)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def prepare_images(image_sources, previous_images: dict = None, workers: int = 1):
+    previous_images = previous_images or dict()
+    images = dict()
+    pending = []
+
+    for image_source in image_sources:
+        signature = get_image_signature(image_source)
+        previous = previous_images.get(image_source)
+
+        if previous and previous[0] == signature and os.path.exists(previous[1]):
+            images[image_source] = previous
+        else:
+            pending.append((image_source, signature))
+
+    if workers > 1 and len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            prepared = list(
+                executor.map(
+                    prepare_image,
+                    [image_source for image_source, _ in pending],
+                    chunksize=max(1, len(pending) // (workers * 4)),
+                )
+            )
+    else:
+        prepared = [prepare_image(image_source) for image_source, _ in pending]
+
+    for (image_source, signature), image_path in zip(pending, prepared):
+        images[image_source] = (signature, image_path, get_image_hash(image_path))
+
+    return images
+
+
+def read_message_records(file_path: str, previous: MessageTree = None):
+    previous_records = previous.records if previous else None
+    previous_images = previous.images if previous else None
 
     with open(file_path, "r", encoding="utf-8") as file:
-        for line in file:
-            if not line.strip():
-                continue
-
-            parts = line.split("|")
-            text = prepare_text(parts[1])
-
-            node_id = parts[0].strip()
-            short_text = parts[2].strip()
-            image_path = get_image_path(parts[3].strip()) if parts[3].strip() else None
-            if image_path:
-                image_path = prepare_image(image_path)
-
-            node = MessageNode(text, short_text, image_path)
-            if messages_tree:
-                messages_tree.add_node(node_id, node)
-                short_node_id = get_hash(node_id)
-                nodes_ids[short_node_id] = node_id
-                nodes_ids[node_id] = short_node_id
-            else:
-                messages_tree = node
-
-    return messages_tree, nodes_ids
+        records = parse_message_lines(iter_lines(file), previous_records)
+
+    return records, prepare_images(
+        collect_images(records), previous_images, IMAGES_WORKERS
+    )
+
+
+def build_message_tree(records, images: dict, source_hash: bytes):
+    nodes = []
+    index = dict()
+    version = get_tree_version(source_hash)
+
+    for position, (_, node_id, text, short_text, image_source) in enumerate(records):
+        _, image_path, image_hash = images[image_source] if image_source else NO_IMAGE
+        if position:
+            node = MessageNode(text, short_text, image_path, image_hash, position)
+            index[node_id] = node
+        else:
+            node = RootNode(text, short_text, image_path, image_hash, version)
+        nodes.append(node)
+
+    messages_tree = nodes[0]
+    messages_tree.index = index
+    for node_id, node in index.items():
+        messages_tree.link_node(node_id, node)
+
+    return MessageTree(messages_tree, nodes, version, records, images)
+
+
+def parse_message_tree(file_path: str, previous: MessageTree = None):
+    return build_message_tree(
+        *read_message_records(file_path, previous), get_file_hash(file_path)
+    )
+
+
+def load_message_tree(file_path: str):
+    source_hash = get_file_hash(file_path)
+    snapshot = load_snapshot(file_path, source_hash)
+
+    if snapshot is None:
+        snapshot = read_message_records(file_path)
+        write_snapshot(file_path, snapshot, source_hash)
+    else:
+        # The tree file is unchanged, but its images may have been replaced
+        records, images = snapshot
+        current = prepare_images(collect_images(records), images, IMAGES_WORKERS)
+        if current != images:
+            snapshot = records, current
+            write_snapshot(file_path, snapshot, source_hash)
+
+    return build_message_tree(*snapshot, source_hash)
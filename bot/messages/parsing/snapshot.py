@@ -0,0 +1,72 @@
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+from uuid import uuid4 as uuid
+from logger_config import logger
+
+SNAPSHOT_MAGIC = b"IBTS"
+SNAPSHOT_VERSION = 5
+SNAPSHOT_HEADER = struct.Struct("<4sH32s")
+
+
+def get_snapshot_path(tree_path: str) -> str:
+    return f"{tree_path}.snapshot"
+
+
+def get_file_hash(file_path: str) -> bytes:
+    hash_function = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            hash_function.update(chunk)
+    return hash_function.digest()
+
+
+def get_content_hash(content: bytes) -> bytes:
+    return hashlib.sha256(content).digest()
+
+
+def write_snapshot(tree_path: str, snapshot: tuple, source_hash: bytes) -> bool:
+    snapshot_path = get_snapshot_path(tree_path)
+    tmp_path = f"{snapshot_path}.{uuid()}.tmp"
+
+    try:
+        with open(tmp_path, "wb") as file:
+            file.write(
+                SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, source_hash)
+            )
+            file.write(marshal.dumps(snapshot))
+        os.replace(tmp_path, snapshot_path)
+        return True
+    except OSError as e:
+        logger.error(f"Write tree snapshot error: {e}", exc_info=True)
+        return False
+
+
+def load_snapshot(tree_path: str, source_hash: bytes):
+    snapshot_path = get_snapshot_path(tree_path)
+
+    try:
+        with open(snapshot_path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+                if len(snapshot) < SNAPSHOT_HEADER.size:
+                    return
+
+                magic, version, snapshot_hash = SNAPSHOT_HEADER.unpack_from(snapshot)
+                if (
+                    magic != SNAPSHOT_MAGIC
+                    or version != SNAPSHOT_VERSION
+                    or snapshot_hash != source_hash
+                ):
+                    return
+
+                with memoryview(snapshot) as view:
+                    records, images = marshal.loads(view[SNAPSHOT_HEADER.size :])
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, EOFError, TypeError) as e:
+        logger.error(f"Load tree snapshot error: {e}", exc_info=True)
+        return
+
+    return records, images
@@ -0,0 +1,168 @@
+import os
+import re
+from types import MappingProxyType
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from bot.messages.image_cache import image_cache
+from bot.messages.message_node import MessageNode
+from bot.messages.message_tree import get_callback_data
+from dotenv import load_dotenv
+
+load_dotenv()
+
+render_mode = os.environ.get("RENDER_MODE", "sequential").lower()
+MESSAGE_LIMIT = 4096
+CAPTION_LIMIT = 1024
+MARKDOWN_SPECIAL = re.compile(r"[_*\[\]()~`>#+\-=|{}.!\\]")
+
+
+class TextOperation:
+    __slots__ = ("text", "options")
+
+    def __init__(self, text: str, **options):
+        self.text = text
+        self.options = MappingProxyType(options)
+
+    async def send(self, message):
+        return await message.answer(self.text, **self.options)
+
+    async def reply(self, message):
+        return message.answer(self.text, **self.options)
+
+
+class PhotoOperation:
+    __slots__ = ("node", "options")
+
+    def __init__(self, node: MessageNode, **options):
+        self.node = node
+        self.options = MappingProxyType(options)
+
+    async def send(self, message):
+        return await image_cache.answer_photo(message, self.node, **self.options)
+
+    async def reply(self, message):
+        await self.send(message)
+
+
+def get_keyboard_from_choices(choices, version: str) -> InlineKeyboardMarkup:
+    button_list = []
+    for node in choices:
+        button_list.append(
+            [
+                InlineKeyboardButton(
+                    text=node.short_text,
+                    callback_data=get_callback_data(version, node.position),
+                )
+            ]
+        )
+    return InlineKeyboardMarkup(inline_keyboard=button_list)
+
+
+def escape_markdown(text: str) -> str:
+    return MARKDOWN_SPECIAL.sub(r"\\\g<0>", text)
+
+
+def get_text_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def join_texts(short_text: str, text: str, limit: int):
+    if not short_text:
+        return text
+
+    joined = (
+        f"{escape_markdown(short_text)}\n\n{text}"
+        if text
+        else escape_markdown(short_text)
+    )
+    if get_text_length(joined) <= limit:
+        return joined
+
+
+def compile_sequential_plan(node: MessageNode, reply_markup) -> list:
+    operations = []
+
+    if node.parent is not None:
+        operations.append(TextOperation(node.short_text, protect_content=True))
+
+    if node.image:
+        if node.text:
+            operations.append(PhotoOperation(node, protect_content=True))
+        else:
+            operations.append(
+                PhotoOperation(node, reply_markup=reply_markup, protect_content=True)
+            )
+
+    if node.text:
+        operations.append(
+            TextOperation(
+                node.text,
+                reply_markup=reply_markup,
+                parse_mode="MarkdownV2",
+                protect_content=True,
+            )
+        )
+
+    return operations
+
+
+def compile_compact_plan(node: MessageNode, reply_markup) -> list:
+    limit = CAPTION_LIMIT if node.image else MESSAGE_LIMIT
+    operations = []
+    body = node.text
+
+    if node.parent is not None:
+        joined = join_texts(node.short_text, body, limit)
+        if joined is None:
+            operations.append(TextOperation(node.short_text, protect_content=True))
+        else:
+            body = joined
+
+    if node.image and body and get_text_length(body) > CAPTION_LIMIT:
+        return operations + compile_sequential_plan(node, reply_markup)[-2:]
+
+    if node.image:
+        options = dict(reply_markup=reply_markup, protect_content=True)
+        if body:
+            options.update(caption=body, parse_mode="MarkdownV2")
+        operations.append(PhotoOperation(node, **options))
+    elif body:
+        operations.append(
+            TextOperation(
+                body,
+                reply_markup=reply_markup,
+                parse_mode="MarkdownV2",
+                protect_content=True,
+            )
+        )
+
+    return operations
+
+
+def compile_render_plan(node: MessageNode) -> tuple:
+    reply_markup = get_keyboard_from_choices(node.choices, node.get_root().version)
+
+    if render_mode == "compact":
+        return tuple(compile_compact_plan(node, reply_markup))
+    return tuple(compile_sequential_plan(node, reply_markup))
+
+
+def get_render_plan(node: MessageNode) -> tuple:
+    plan = node.render_plan
+    if plan is None:
+        plan = node.render_plan = compile_render_plan(node)
+    return plan
+
+
+async def render_node(message, node: MessageNode, reply: bool = False):
+    plan = get_render_plan(node)
+    if not plan:
+        return
+
+    if not reply:
+        for operation in plan:
+            await operation.send(message)
+        return
+
+    for operation in plan[:-1]:
+        await operation.send(message)
+    return await plan[-1].reply(message)
@@ -0,0 +1,22 @@
+from typing import Any, Awaitable, Callable, Dict
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from db.redis.client import UserDatabase
+
+
+class SessionMiddleware(BaseMiddleware):
+    def __init__(self, users: UserDatabase, enabled: bool = True):
+        self.users = users
+        self.enabled = enabled
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        chat = data.get("event_chat")
+        data["user_session"] = (
+            await self.users.get_session(chat.id) if self.enabled and chat else None
+        )
+        return await handler(event, data)
@@ -1,35 +1,238 @@
+import asyncio
+import csv
+import io
 import os
-import shutil
-from bot.messages.parsing.parser import parse_message_tree
+from concurrent.futures import ProcessPoolExecutor
+from bot.messages.message_tree import MessageTree
+from bot.messages.parsing.parser import (
+    build_message_tree,
+    collect_images,
+    parse_message_text,
+    prepare_images,
+)
+from bot.messages.parsing.snapshot import get_content_hash, write_snapshot
+from db.redis.client import add_priveleged_users, trees
+from utils.image_utils import IMAGES_WORKERS
+from logger_config import logger
 from uuid import uuid4 as uuid
 from dotenv import load_dotenv
 
 load_dotenv()
 
 TREE_PATH = os.environ.get("TREE_PATH")
-TREE_DIR = TREE_PATH[: TREE_PATH.rindex("/")]
 
+upload_lock = asyncio.Lock()
+executor = None
 
-async def handle_text_file(bot, message, file_path):
 
-    tmp_destination = os.path.join(TREE_DIR, f"{uuid()}.txt")
-    await bot.download_file(file_path, tmp_destination)
+def get_executor() -> ProcessPoolExecutor:
+    global executor
 
-    try:
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=IMAGES_WORKERS)
+    return executor
+
+
+def save_tree_file(content: bytes, snapshot: tuple):
+    tmp_destination = f"{TREE_PATH}.{uuid()}.tmp"
+    with open(tmp_destination, "wb") as file:
+        file.write(content)
+    os.replace(tmp_destination, TREE_PATH)
+    write_snapshot(TREE_PATH, snapshot, get_content_hash(content))
+
+
+class UploadProgress:
+    def __init__(self, bot, chat_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.nodes = 0
+        self.message_id = None
+
+    def get_text(self, done: int, total: int) -> str:
+        return (
+            f"Файл разобран, узлов: {self.nodes}. "
+            f"Подготовка изображений: {done}/{total}"
+        )
+
+    async def parsed(self, nodes: int, images: int):
+        self.nodes = nodes
+        message = await self.bot.send_message(
+            chat_id=self.chat_id, text=self.get_text(0, images)
+        )
+        self.message_id = message.message_id
+
+    async def images_prepared(self, done: int, total: int):
+        await self.bot.edit_message_text(
+            self.get_text(done, total),
+            chat_id=self.chat_id,
+            message_id=self.message_id,
+        )
+
+
+async def compile_tree(
+    content: bytes, previous: MessageTree = None, progress: UploadProgress = None
+) -> MessageTree:
+    loop = asyncio.get_running_loop()
+
+    records = await loop.run_in_executor(
+        get_executor(),
+        parse_message_text,
+        content,
+        previous.records if previous else None,
+    )
+    images = collect_images(records)
+    if progress:
+        await progress.parsed(len(records), len(images))
+
+    previous_images = previous.images if previous else dict()
+    chunk_size = max(1, len(images) // (IMAGES_WORKERS * 4))
+    chunks = [
+        images[start : start + chunk_size]
+        for start in range(0, len(images), chunk_size)
+    ]
+    futures = [
+        loop.run_in_executor(
+            get_executor(),
+            prepare_images,
+            chunk,
+            {
+                image: previous_images[image]
+                for image in chunk
+                if image in previous_images
+            },
+        )
+        for chunk in chunks
+    ]
+
+    prepared_images = dict()
+    for future in asyncio.as_completed(futures):
+        prepared_images.update(await future)
+        if progress:
+            await progress.images_prepared(len(prepared_images), len(images))
+
+    messages_tree = await asyncio.to_thread(
+        build_message_tree,
+        records,
+        prepared_images,
+        get_content_hash(content),
+    )
+    await asyncio.to_thread(save_tree_file, content, (records, prepared_images))
+    return messages_tree
+
+
+async def handle_text_file(bot, message, file_path, previous: MessageTree = None):
+
+    async with upload_lock:
+        try:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=f"Начинаю загрузку файла с деревом диалога",
+            )
+            content = (await bot.download_file(file_path)).getvalue()
+
+            messages_tree = await compile_tree(
+                content, previous, UploadProgress(bot, message.chat.id)
+            )
+
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=f"Файл с деревом диалога загружен, применяю новое дерево",
+            )
+            return messages_tree, content
+        except Exception as e:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=f"Ошибка при парсинге файла с деревом диалога: {str(e)}",
+            )
 
+
+async def publish_tree(bot, message, messages_tree: MessageTree, content: bytes):
+    if not await trees.publish_tree(messages_tree.version, content.decode("utf-8")):
         await bot.send_message(
-            chat_id=message.chat.id, text=f"Начинаю загрузку файла с деревом диалога"
+            chat_id=message.chat.id,
+            text=f"Не удалось разослать дерево диалога другим процессам",
+        )
+
+
+async def load_published_tree(previous: MessageTree = None):
+    version = await trees.get_version()
+    if not version or (previous and previous.version == version):
+        return
+
+    version, content = await trees.get_tree()
+    if not content or (previous and previous.version == version):
+        return
+
+    async with upload_lock:
+        try:
+            return await compile_tree(content.encode("utf-8"), previous)
+        except Exception as e:
+            logger.error(f"Load published tree {version} error: {e}", exc_info=True)
+
+
+async def publish_local_tree(local: MessageTree) -> bool:
+    # The tree file wins over the published tree only when it was modified
+    # after that publication, otherwise the published tree replaces it
+    version, published_at = await trees.get_published()
+    if version == local.version:
+        return False
+
+    modified_at = os.path.getmtime(TREE_PATH)
+    if version and modified_at <= published_at:
+        return False
+
+    with open(TREE_PATH, "rb") as file:
+        content = file.read()
+    logger.info(f"Publishing tree version {local.version} from {TREE_PATH}")
+    return await trees.publish_tree(local.version, content.decode("utf-8"), modified_at)
+
+
+def parse_user_ids(content: bytes):
+    user_ids = list()
+    invalid = 0
+
+    for row in csv.reader(io.StringIO(content.decode("utf-8-sig"))):
+        cells = [cell.strip() for cell in row if cell.strip()]
+        if not cells:
+            continue
+        try:
+            user_ids.append(str(int(cells[0])))
+        except ValueError:
+            invalid += 1
+
+    return user_ids, invalid
+
+
+def get_import_report(counts: dict, invalid: int = 0) -> str:
+    return (
+        f"Доступ выдан: {counts['granted']}, уже был: {counts['already']}, "
+        f"ошибок записи: {counts['failed']}, некорректных строк: {invalid}"
+    )
+
+
+async def handle_users_file(bot, message, file_path):
+
+    try:
+        content = (await bot.download_file(file_path)).getvalue()
+        user_ids, invalid = parse_user_ids(content)
+        progress_message = await bot.send_message(
+            chat_id=message.chat.id,
+            text=f"Импорт пользователей: 0/{len(user_ids)}",
         )
-        result = parse_message_tree(tmp_destination)
 
-        shutil.move(tmp_destination, TREE_PATH)
+        async def progress(done: int, total: int):
+            await bot.edit_message_text(
+                f"Импорт пользователей: {done}/{total}",
+                chat_id=message.chat.id,
+                message_id=progress_message.message_id,
+            )
 
+        counts = await add_priveleged_users(user_ids, progress)
         await bot.send_message(
-            chat_id=message.chat.id, text=f"Файл с деревом диалога загружен"
+            chat_id=message.chat.id, text=get_import_report(counts, invalid)
         )
-        return result
     except Exception as e:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=f"Ошибка при парсинге файла с деревом диалога: {str(e)}",
+            text=f"Ошибка при импорте пользователей: {str(e)}",
         )
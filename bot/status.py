@@ -0,0 +1,19 @@
+import os
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+import bot.bot as telegram_bot
+
+router = APIRouter(prefix="/infobot")
+
+
+@router.get("/ready")
+async def ready():
+    messages_tree = telegram_bot.messages_tree
+    return JSONResponse(
+        status_code=200 if messages_tree else 503,
+        content={
+            "ready": messages_tree is not None,
+            "tree_version": messages_tree.version if messages_tree else None,
+            "pid": os.getpid(),
+        },
+    )
@@ -0,0 +1,39 @@
+from fastapi import APIRouter, HTTPException, Request
+from aiogram.methods import TelegramMethod
+from bot.bot import bot, dp, webhook_secret
+from logger_config import logger
+
+router = APIRouter(prefix="/infobot")
+
+
+def build_webhook_reply(result: TelegramMethod):
+    files = dict()
+    reply = {"method": result.__api_method__}
+
+    for key, value in result.model_dump(warnings=False).items():
+        value = bot.session.prepare_value(
+            value, bot=bot, files=files, _dumps_json=False
+        )
+        if value is not None:
+            reply[key] = value
+
+    if not files:
+        return reply
+
+
+@router.post("/telegram")
+async def telegram_webhook(request: Request):
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
+    if not webhook_secret or secret != webhook_secret:
+        logger.info("Telegram webhook secret mismatch")
+        raise HTTPException(status_code=403)
+
+    result = await dp.feed_webhook_update(bot, await request.json())
+
+    if isinstance(result, TelegramMethod):
+        reply = build_webhook_reply(result)
+        if reply:
+            return reply
+        await dp.silent_call_request(bot=bot, result=result)
+
+    return {}
@@ -0,0 +1,558 @@
+"""In-process asyncio stand-in for the subset of redis.asyncio.Redis used by db.redis.
+
+Values are kept as str (matching decode_responses=True), bitmaps as
+bytearray, hashes as dict and sets as set. Commands run synchronously
+inside the event loop, so a transaction is atomic simply by not awaiting
+between its commands. Lua scripts are not interpreted: register_script
+looks up the Python port registered for the same source in
+db.redis.scripts.
+"""
+
+import asyncio
+import fnmatch
+import hashlib
+import time
+
+from redis.exceptions import ResponseError, WatchError
+
+from db.redis.scripts import PYTHON_SCRIPTS
+
+STREAM_POLL = 0.01
+
+
+def parse_stream_id(value: str) -> tuple:
+    milliseconds, _, sequence = str(value).partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+def format_stream_id(value: tuple) -> str:
+    return f"{value[0]}-{value[1]}"
+
+
+class MemoryStream:
+    def __init__(self):
+        self.entries = dict()
+        self.last_id = (0, 0)
+        self.groups = dict()
+
+    def next_id(self) -> tuple:
+        milliseconds = int(time.time() * 1000)
+        if milliseconds <= self.last_id[0]:
+            return self.last_id[0], self.last_id[1] + 1
+        return milliseconds, 0
+
+    def get_group(self, name: str) -> dict:
+        group = self.groups.get(name)
+        if group is None:
+            raise ResponseError(f"NOGROUP No such consumer group '{name}'")
+        return group
+
+
+TYPES = {
+    str: "string",
+    bytearray: "string",
+    dict: "hash",
+    set: "set",
+    list: "list",
+    MemoryStream: "stream",
+}
+
+
+class MemoryEngine:
+    def __init__(self):
+        self.data = dict()
+        self.expires = dict()
+        self.versions = dict()
+        self.channels = dict()
+
+    def run(self, name: str, *args, **kwargs):
+        return getattr(self, f"command_{name.lower()}")(*args, **kwargs)
+
+    def has_command(self, name: str) -> bool:
+        return hasattr(self, f"command_{name.lower()}")
+
+    def alive(self, key: str) -> bool:
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+            self.touch(key)
+        return key in self.data
+
+    def touch(self, key: str):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def lookup(self, key: str, kind: type, create: bool = False):
+        if not self.alive(key):
+            if not create:
+                return None
+            self.data[key] = kind()
+        value = self.data[key]
+        if not isinstance(value, kind):
+            raise ResponseError(
+                "WRONGTYPE Operation against a key holding the wrong kind of value"
+            )
+        return value
+
+    def store(self, key: str, value, ttl: float = None, keep_ttl: bool = False):
+        self.data[key] = value
+        if ttl is not None:
+            self.expires[key] = time.monotonic() + ttl
+        elif not keep_ttl:
+            self.expires.pop(key, None)
+        self.touch(key)
+
+    def command_ping(self):
+        return True
+
+    def command_get(self, key):
+        return self.lookup(key, str)
+
+    def command_set(
+        self, key, value, ex=None, px=None, nx=False, xx=False, keepttl=False
+    ):
+        exists = self.alive(key)
+        if (nx and exists) or (xx and not exists):
+            return None
+        ttl = ex if ex is not None else (px / 1000 if px is not None else None)
+        self.store(key, str(value), ttl=ttl, keep_ttl=keepttl)
+        return True
+
+    def command_incrby(self, key, amount=1):
+        value = int(self.lookup(key, str) or 0) + int(amount)
+        self.store(key, str(value), keep_ttl=True)
+        return value
+
+    def command_mget(self, keys, *more):
+        keys = [keys, *more] if isinstance(keys, str) else list(keys) + list(more)
+        return [self.lookup(key, str) for key in keys]
+
+    def command_delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self.alive(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                self.touch(key)
+                deleted += 1
+        return deleted
+
+    def command_exists(self, *keys):
+        return sum(self.alive(key) for key in keys)
+
+    def command_expire(self, key, seconds):
+        if not self.alive(key):
+            return False
+        self.expires[key] = time.monotonic() + int(seconds)
+        return True
+
+    def command_ttl(self, key):
+        if not self.alive(key):
+            return -2
+        deadline = self.expires.get(key)
+        return -1 if deadline is None else max(0, round(deadline - time.monotonic()))
+
+    def command_hset(self, key, field=None, value=None, mapping=None):
+        fields = self.lookup(key, dict, create=True)
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        added = sum(name not in fields for name in items)
+        fields.update((name, str(item)) for name, item in items.items())
+        self.touch(key)
+        return added
+
+    def command_hsetnx(self, key, field, value):
+        fields = self.lookup(key, dict, create=True)
+        if field in fields:
+            return False
+        fields[field] = str(value)
+        self.touch(key)
+        return True
+
+    def command_hget(self, key, field):
+        return (self.lookup(key, dict) or {}).get(field)
+
+    def command_hmget(self, key, keys, *more):
+        fields = self.lookup(key, dict) or {}
+        names = [keys, *more] if isinstance(keys, str) else list(keys) + list(more)
+        return [fields.get(name) for name in names]
+
+    def command_hgetall(self, key):
+        return dict(self.lookup(key, dict) or {})
+
+    def command_hdel(self, key, *names):
+        fields = self.lookup(key, dict)
+        if not fields:
+            return 0
+        deleted = sum(fields.pop(name, None) is not None for name in names)
+        if not fields:
+            self.command_delete(key)
+        elif deleted:
+            self.touch(key)
+        return deleted
+
+    def command_setbit(self, key, offset, value):
+        bits = self.lookup(key, bytearray, create=True)
+        offset, value = int(offset), int(value)
+        index, mask = offset // 8, 0x80 >> (offset % 8)
+        if len(bits) <= index:
+            bits.extend(bytes(index + 1 - len(bits)))
+        previous = int(bool(bits[index] & mask))
+        bits[index] = bits[index] | mask if value else bits[index] & ~mask
+        self.touch(key)
+        return previous
+
+    def command_getbit(self, key, offset):
+        bits = self.lookup(key, bytearray) or bytearray()
+        offset = int(offset)
+        index = offset // 8
+        return int(index < len(bits) and bool(bits[index] & (0x80 >> offset % 8)))
+
+    def command_bitcount(self, key):
+        bits = self.lookup(key, bytearray) or bytearray()
+        return sum(bin(byte).count("1") for byte in bits)
+
+    def command_sadd(self, key, *members):
+        values = self.lookup(key, set, create=True)
+        members = {str(member) for member in members}
+        added = len(members - values)
+        values.update(members)
+        self.touch(key)
+        return added
+
+    def command_smembers(self, key):
+        return set(self.lookup(key, set) or set())
+
+    def command_publish(self, channel, message):
+        queues = self.channels.get(channel, set())
+        for queue in queues:
+            queue.put_nowait({"type": "message", "channel": channel, "data": message})
+        return len(queues)
+
+    def command_rpush(self, key, *values):
+        items = self.lookup(key, list, create=True)
+        items.extend(str(value) for value in values)
+        self.touch(key)
+        return len(items)
+
+    def command_llen(self, key):
+        return len(self.lookup(key, list) or [])
+
+    def command_lrange(self, key, start, end):
+        items = self.lookup(key, list) or []
+        end = int(end)
+        return items[int(start) : None if end == -1 else end + 1]
+
+    def command_xadd(
+        self, key, fields, id="*", maxlen=None, approximate=True, nomkstream=False
+    ):
+        if nomkstream and not self.alive(key):
+            return None
+        stream = self.lookup(key, MemoryStream, create=True)
+        entry_id = stream.next_id() if id == "*" else parse_stream_id(id)
+        if entry_id <= stream.last_id:
+            raise ResponseError(
+                "ERR The ID specified in XADD is equal or smaller than the target stream top item"
+            )
+        stream.entries[entry_id] = {
+            str(name): str(value) for name, value in fields.items()
+        }
+        stream.last_id = entry_id
+        while maxlen is not None and len(stream.entries) > int(maxlen):
+            del stream.entries[next(iter(stream.entries))]
+        self.touch(key)
+        return format_stream_id(entry_id)
+
+    def command_xlen(self, key):
+        return len((self.lookup(key, MemoryStream) or MemoryStream()).entries)
+
+    def command_xdel(self, key, *ids):
+        stream = self.lookup(key, MemoryStream)
+        if stream is None:
+            return 0
+        deleted = sum(
+            stream.entries.pop(parse_stream_id(entry_id), None) is not None
+            for entry_id in ids
+        )
+        self.touch(key)
+        return deleted
+
+    def command_xgroup_create(self, name, groupname, id="$", mkstream=False):
+        if not self.alive(name) and not mkstream:
+            raise ResponseError(
+                "ERR The XGROUP subcommand requires the key to exist. "
+                "Note that for CREATE you may want to use the MKSTREAM option "
+                "to create an empty stream automatically."
+            )
+        stream = self.lookup(name, MemoryStream, create=True)
+        if groupname in stream.groups:
+            raise ResponseError("BUSYGROUP Consumer Group name already exists")
+        last = stream.last_id if id == "$" else parse_stream_id(id)
+        stream.groups[groupname] = {"last": last, "pending": dict()}
+        self.touch(name)
+        return True
+
+    def command_xreadgroup(
+        self, groupname, consumername, streams, count=None, block=None, noack=False
+    ):
+        result = list()
+        now = time.monotonic()
+        for key, start in streams.items():
+            stream = self.lookup(key, MemoryStream)
+            if stream is None:
+                raise ResponseError(f"NOGROUP No such key '{key}'")
+            group = stream.get_group(groupname)
+
+            if start == ">":
+                ids = [
+                    entry_id for entry_id in stream.entries if entry_id > group["last"]
+                ]
+                ids = ids[: int(count)] if count else ids
+                if ids:
+                    group["last"] = ids[-1]
+                for entry_id in ids if not noack else ():
+                    group["pending"][entry_id] = [consumername, now, 1]
+            else:
+                ids = sorted(
+                    entry_id
+                    for entry_id, (consumer, _, _) in group["pending"].items()
+                    if consumer == consumername and entry_id > parse_stream_id(start)
+                )
+                ids = ids[: int(count)] if count else ids
+
+            entries = [
+                (format_stream_id(entry_id), stream.entries.get(entry_id))
+                for entry_id in ids
+            ]
+            if entries or start != ">":
+                result.append([key, entries])
+        return result
+
+    def command_xack(self, name, groupname, *ids):
+        stream = self.lookup(name, MemoryStream)
+        if stream is None:
+            return 0
+        pending = stream.get_group(groupname)["pending"]
+        return sum(
+            pending.pop(parse_stream_id(entry_id), None) is not None for entry_id in ids
+        )
+
+    def command_xautoclaim(
+        self,
+        name,
+        groupname,
+        consumername,
+        min_idle_time,
+        start_id="0-0",
+        count=None,
+        justid=False,
+    ):
+        stream = self.lookup(name, MemoryStream)
+        if stream is None:
+            raise ResponseError(f"NOGROUP No such key '{name}'")
+        pending = stream.get_group(groupname)["pending"]
+        now = time.monotonic()
+        start, count = parse_stream_id(start_id), int(count or 100)
+        ids = sorted(entry_id for entry_id in pending if entry_id >= start)
+
+        claimed, deleted, next_id = list(), list(), "0-0"
+        for index, entry_id in enumerate(ids):
+            if len(claimed) + len(deleted) >= count:
+                next_id = format_stream_id(ids[index])
+                break
+            state = pending[entry_id]
+            if (now - state[1]) * 1000 < int(min_idle_time):
+                continue
+            if entry_id not in stream.entries:
+                del pending[entry_id]
+                deleted.append(format_stream_id(entry_id))
+                continue
+            state[0], state[1] = consumername, now
+            if not justid:
+                state[2] += 1
+            claimed.append(entry_id)
+
+        if justid:
+            return [format_stream_id(entry_id) for entry_id in claimed]
+        entries = [
+            (format_stream_id(entry_id), stream.entries[entry_id])
+            for entry_id in claimed
+        ]
+        return [next_id, entries, deleted]
+
+    def scan(self, match: str = None, type: str = None) -> list:
+        keys = list()
+        for key in list(self.data):
+            if not self.alive(key):
+                continue
+            if match and not fnmatch.fnmatchcase(key, match):
+                continue
+            if type and TYPES[self.data[key].__class__] != type.lower():
+                continue
+            keys.append(key)
+        return keys
+
+
+class MemoryPipeline:
+    def __init__(self, engine: MemoryEngine, transaction: bool = True):
+        self.engine = engine
+        self.transaction = transaction
+        self.commands = list()
+        self.watched = None
+        self.explicit_multi = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.reset()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def reset(self):
+        self.commands.clear()
+        self.watched = None
+        self.explicit_multi = False
+
+    async def watch(self, *keys):
+        self.watched = {key: self.engine.versions.get(key, 0) for key in keys}
+        return True
+
+    def multi(self):
+        self.explicit_multi = True
+
+    def __getattr__(self, name: str):
+        if not self.engine.has_command(name):
+            raise AttributeError(name)
+
+        if self.watched is not None and not self.explicit_multi:
+
+            async def immediate(*args, **kwargs):
+                return self.engine.run(name, *args, **kwargs)
+
+            return immediate
+
+        def stage(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return stage
+
+    async def execute(self, raise_on_error: bool = True):
+        watched = self.watched or {}
+        if any(
+            self.engine.versions.get(key, 0) != version
+            for key, version in watched.items()
+        ):
+            self.reset()
+            raise WatchError("Watched variable changed.")
+
+        results = list()
+        for name, args, kwargs in self.commands:
+            try:
+                results.append(self.engine.run(name, *args, **kwargs))
+            except ResponseError as e:
+                if raise_on_error:
+                    self.reset()
+                    raise
+                results.append(e)
+
+        self.reset()
+        await asyncio.sleep(0)
+        return results
+
+
+class MemoryPubSub:
+    def __init__(self, engine: MemoryEngine):
+        self.engine = engine
+        self.queue = asyncio.Queue()
+        self.subscribed = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self.engine.channels.setdefault(channel, set()).add(self.queue)
+            self.subscribed.add(channel)
+            self.queue.put_nowait(
+                {"type": "subscribe", "channel": channel, "data": len(self.subscribed)}
+            )
+
+    async def listen(self):
+        while self.subscribed:
+            yield await self.queue.get()
+
+    async def aclose(self):
+        for channel in self.subscribed:
+            self.engine.channels.get(channel, set()).discard(self.queue)
+        self.subscribed.clear()
+
+
+class MemoryScript:
+    def __init__(self, client: "MemoryRedis", script: str):
+        self.client = client
+        self.script = script
+        self.sha = hashlib.sha1(script.encode()).hexdigest()
+        self.function = PYTHON_SCRIPTS[script]
+
+    async def __call__(self, keys=(), args=(), client=None):
+        engine = (client or self.client).engine
+        await asyncio.sleep(0)
+        return self.function(engine.run, list(keys), [str(arg) for arg in args])
+
+
+class MemoryRedis:
+    def __init__(self, engine: MemoryEngine = None):
+        self.engine = engine or MemoryEngine()
+
+    def __getattr__(self, name: str):
+        if not self.engine.has_command(name):
+            raise AttributeError(name)
+
+        async def command(*args, **kwargs):
+            await asyncio.sleep(0)
+            return self.engine.run(name, *args, **kwargs)
+
+        return command
+
+    async def xreadgroup(
+        self, groupname, consumername, streams, count=None, block=None, noack=False
+    ):
+        deadline = None
+        if block is not None:
+            deadline = time.monotonic() + (int(block) / 1000 or float("inf"))
+        while True:
+            result = self.engine.run(
+                "xreadgroup", groupname, consumername, streams, count, noack=noack
+            )
+            if result or deadline is None or time.monotonic() >= deadline:
+                return result
+            await asyncio.sleep(STREAM_POLL)
+
+    def pipeline(self, transaction: bool = True) -> MemoryPipeline:
+        return MemoryPipeline(self.engine, transaction)
+
+    def pubsub(self) -> MemoryPubSub:
+        return MemoryPubSub(self.engine)
+
+    async def scan_iter(self, match: str = None, count: int = None, _type: str = None):
+        for key in self.engine.scan(match, _type):
+            yield key
+
+    def register_script(self, script: str) -> MemoryScript:
+        return MemoryScript(self, script)
+
+    async def script_load(self, script: str) -> str:
+        return MemoryScript(self, script).sha
+
+    async def aclose(self):
+        pass
+
+    async def close(self):
+        pass
@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class PaymentInfoCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, client_id: str):
+        entry = self.entries.get(client_id)
+
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[client_id]
+            self.misses += 1
+            return MISSING
+
+        self.entries.move_to_end(client_id)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, client_id: str, value: dict, generation: int):
+        if generation != self.generation or self.max_size <= 0:
+            return
+
+        self.entries[client_id] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(client_id)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, client_id: str):
+        self.generation += 1
+        self.invalidations += 1
+        self.entries.pop(client_id, None)
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,10 +1,21 @@
 from dotenv import load_dotenv
 import os
 from redis import asyncio as aioredis
-import json, asyncio
+from redis.exceptions import ResponseError, WatchError
+import json, asyncio, time
 from logger_config import logger
-from typing import Dict, Iterable, Union
+from typing import Dict, Iterable, NamedTuple, Optional, Union
 from enum import Enum
+from db.redis.cache import MISSING, PaymentInfoCache
+from db.redis.codec import Codec, JsonCodec, PaymentCodec, StringCodec
+from db.redis.scripts import (
+    CLOSE_PAYMENT_SCRIPT,
+    CREATE_PAYMENT_SCRIPT,
+    ENQUEUE_EVENT_SCRIPT,
+    PAYMENT_CANCELED,
+    PAYMENT_SUCCEEDED,
+    SET_PAID_SCRIPT,
+)
 
 load_dotenv()
 
@@ -13,22 +24,77 @@ port = int(os.environ.get("DB_PORT"))
 user = os.environ.get("DB_USER")
 password = os.environ.get("DB_PASSWORD")
 
+database_number = int(os.environ.get("DB_NUMBER", 0))
+pool_size = int(os.environ.get("DB_POOL_SIZE", 50))
+pool_timeout = float(os.environ.get("DB_POOL_TIMEOUT", 20))
+storage_backend = os.environ.get("DB_BACKEND", "redis").lower()
+
 connection_string = f"redis://{host}:{port}"
 
+payment_cache_size = int(os.environ.get("PAYMENT_CACHE_SIZE", 100000))
+payment_cache_ttl = float(os.environ.get("PAYMENT_CACHE_TTL", 300))
+privileged_chunk_size = int(os.environ.get("PAYMENT_PRIVILEGED_CHUNK_SIZE", 1000))
+pending_payment_ttl = int(os.environ.get("PAYMENT_PENDING_TTL", 3 * 24 * 3600))
+session_ttl = int(os.environ.get("SESSION_TTL", 24 * 3600))
+processed_payment_ttl = int(os.environ.get("PAYMENT_PROCESSED_TTL", 7 * 24 * 3600))
+payment_lock_ttl = int(os.environ.get("PAYMENT_LOCK_TTL", 60))
+event_dedup_ttl = int(os.environ.get("PAYMENT_EVENT_DEDUP_TTL", 24 * 3600))
+event_stream_max_length = int(os.environ.get("PAYMENT_EVENT_STREAM_MAX_LENGTH", 100000))
+INVALIDATION_CHANNEL = "payments:invalidate"
+TREE_CHANNEL = "tree:version"
+TREE_VERSION_KEY = "version"
+TREE_CONTENT_KEY = "content"
+TREE_PUBLISHED_KEY = "published"
+SESSION_PREFIX = "session:"
+PENDING_PREFIX = "pending:"
+PAID_PREFIX = "paid:"
+PAYMENT_LOCK_PREFIX = "payment-lock:"
+PAYMENT_RESULT_PREFIX = "payment-result:"
+PAID_COUNT_KEY = "paid-count"
+# 64 users per shard: a shard is at most 8 bytes, so a lone paid user costs
+# no more than a per-user key did, while dense id ranges pack 64 to a key
+PAID_SHARD_BITS = 6
+EVENT_STREAM_KEY = "events"
+EVENT_DEAD_KEY = "dead"
+EVENT_SEEN_PREFIX = "seen:"
+EVENT_GROUP = "payments"
+
+
+def create_client(backend: str = None):
+    backend = backend or storage_backend
+
+    if backend == "memory":
+        from db.memory.engine import MemoryRedis
+
+        return MemoryRedis()
+
+    connection_pool = aioredis.BlockingConnectionPool.from_url(
+        connection_string,
+        username=user,
+        password=password,
+        db=database_number,
+        decode_responses=True,
+        max_connections=pool_size,
+        timeout=pool_timeout,
+    )
+    return aioredis.Redis(connection_pool=connection_pool)
+
+
+redis = create_client()
+
 
 class RedisDatabase:
-    def __init__(self, db_number):
-        self.redis = aioredis.from_url(
-            connection_string,
-            username=user,
-            password=password,
-            db=db_number,
-            decode_responses=True,
-        )
+    def __init__(self, namespace: str, codec: Codec = None, client=None):
+        self.namespace = namespace
+        self.codec = codec or JsonCodec()
+        self.redis = client or redis
+
+    def key(self, key) -> str:
+        return f"{self.namespace}:{key}"
 
     async def set_key(self, key, value):
         try:
-            await self.redis.set(key, json.dumps(value))
+            await self.redis.set(self.key(key), self.codec.encode(value))
             return True
         except Exception as e:
             logger.error(f"Set key error: {e}", exc_info=True)
@@ -36,108 +102,411 @@ class RedisDatabase:
 
     async def get_key(self, key):
         try:
-            value = await self.redis.get(key)
-            return json.loads(value) if value else dict()
+            value = await self.redis.get(self.key(key))
+            return self.codec.decode(value) if value else dict()
         except Exception as e:
             logger.error(f"Get key error: {e}", exc_info=True)
 
     async def delete(self, key):
         try:
-            return await self.redis.delete(key)
+            return await self.redis.delete(self.key(key))
         except Exception as e:
             logger.error(f"Delete record error: {e}", exc_info=True)
 
-    async def close(self):
-        await self.redis.close()
+    def is_legacy(self, raw: str) -> bool:
+        return self.codec.is_legacy(raw)
+
+    def stage_conversion(self, pipe, key: str, raw: str):
+        pipe.set(key, self.codec.encode(self.codec.decode(raw)), keepttl=True)
+
+    async def convert_keys(self, keys: list) -> int:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            await pipe.watch(*keys)
+            values = await pipe.mget(keys)
+            legacy = [
+                (key, raw)
+                for key, raw in zip(keys, values)
+                if raw and self.is_legacy(raw)
+            ]
+            if not legacy:
+                return 0
+
+            pipe.multi()
+            for key, raw in legacy:
+                self.stage_conversion(pipe, key, raw)
+            await pipe.execute()
+            return len(legacy)
+
+    async def convert_legacy(self, batch_size: int = 500) -> int:
+        converted = skipped = 0
+        keys = list()
+
+        async def flush():
+            nonlocal converted, skipped
+            try:
+                converted += await self.convert_keys(keys)
+            except WatchError:
+                skipped += len(keys)
+            keys.clear()
+
+        try:
+            async for key in self.redis.scan_iter(
+                match=self.key("*"), count=batch_size, _type="STRING"
+            ):
+                keys.append(key)
+                if len(keys) >= batch_size:
+                    await flush()
+            if keys:
+                await flush()
+        except Exception as e:
+            logger.error(f"Convert {self.namespace} error: {e}", exc_info=True)
+
+        logger.info(
+            f"Converted {converted} legacy {self.namespace} records, "
+            f"{skipped} changed during conversion"
+        )
+        return converted
+
+    async def listen(self, channel: str, handler, on_subscribe=None):
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(channel)
+                    if on_subscribe:
+                        await on_subscribe()
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            await handler(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Listener error on {channel}: {e}", exc_info=True)
+                await asyncio.sleep(1)
+
+
+class UserState(Enum):
+    NONE = "none"
+    GIVE_BOT = "give_bot"
+
+
+def get_paid_position(client_id: str):
+    client_id = int(client_id)
+    shard = abs(client_id) >> PAID_SHARD_BITS
+    offset = abs(client_id) & ((1 << PAID_SHARD_BITS) - 1)
+    return f"-{shard}" if client_id < 0 else str(shard), offset
 
 
 class UserDatabase(RedisDatabase):
-    def __init__(self):
-        super().__init__(db_number=1)
+    def __init__(self, client=None):
+        super().__init__(namespace="users", client=client)
+        self.cache = PaymentInfoCache(payment_cache_size, payment_cache_ttl)
+        self.paid_script = self.redis.register_script(SET_PAID_SCRIPT)
+
+    def get_script_args(self) -> list:
+        return [self.key(""), PAID_SHARD_BITS, INVALIDATION_CHANNEL]
+
+    async def load_scripts(self):
+        await self.redis.script_load(self.paid_script.script)
+
+    def session_key(self, client_id: str) -> str:
+        return self.key(f"{SESSION_PREFIX}{client_id}")
+
+    def pending_key(self, client_id: str) -> str:
+        return self.key(f"{PENDING_PREFIX}{client_id}")
+
+    def paid_key(self, shard: str) -> str:
+        return self.key(f"{PAID_PREFIX}{shard}")
+
+    def payment_lock_key(self, client_id: str, target_user: str) -> str:
+        return self.key(f"{PAYMENT_LOCK_PREFIX}{client_id}:{target_user}")
+
+    def payment_result_key(self, client_id: str, target_user: str) -> str:
+        return self.key(f"{PAYMENT_RESULT_PREFIX}{client_id}:{target_user}")
+
+    def stage_legacy_cleanup(self, pipe, client_id: str):
+        pipe.delete(self.key(client_id))
+
+    def stage_pending(self, pipe, client_id: str, confirmation_url: str):
+        pipe.set(self.pending_key(client_id), confirmation_url, ex=pending_payment_ttl)
+
+    def stage_state(self, pipe, client_id: str, state: "UserState"):
+        pipe.hset(self.session_key(client_id), "state", state.value)
+        pipe.expire(self.session_key(client_id), session_ttl)
+
+    async def update_session(self, client_id: str, stage, *args) -> bool:
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                stage(pipe, client_id, *args)
+                pipe.publish(INVALIDATION_CHANNEL, str(client_id))
+                await pipe.execute()
+            result = True
+        except Exception as e:
+            logger.error(f"Update session error: {e}", exc_info=True)
+            result = False
+
+        self.forget(client_id)
+        return result
+
+    async def set_paid(self, client_ids: list, paid: bool) -> int:
+        try:
+            return await self.paid_script(
+                args=[*self.get_script_args(), int(paid), *client_ids]
+            )
+        except Exception as e:
+            logger.error(f"Set paid error: {e}", exc_info=True)
+            return None
+        finally:
+            for client_id in client_ids:
+                self.forget(client_id)
+
+    async def grant_access(self, client_ids: list) -> int:
+        return await self.set_paid(client_ids, True)
+
+    async def count_paid(self) -> int:
+        return int(await self.redis.get(self.key(PAID_COUNT_KEY)) or 0)
+
+    async def read_session(self, client_id: str) -> dict:
+        try:
+            shard, offset = get_paid_position(client_id)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.getbit(self.paid_key(shard), offset)
+                pipe.get(self.pending_key(client_id))
+                pipe.hgetall(self.session_key(client_id))
+                pipe.get(self.key(client_id))
+                paid, confirmation_url, fields, legacy = await pipe.execute()
+
+            if legacy:
+                paid, confirmation_url = await self.fold_legacy(
+                    client_id, json.loads(legacy), paid, confirmation_url
+                )
+        except Exception as e:
+            logger.error(f"Read session error: {e}", exc_info=True)
+            return None
+
+        return {
+            "paid": paid == 1,
+            "confirmation_url": confirmation_url or "",
+            "state": fields.get("state", UserState.NONE.value),
+        }
+
+    async def fold_legacy(self, client_id: str, legacy: dict, paid: int, url: str):
+        if not paid and legacy.get("paid") is True:
+            await self.paid_script(args=[*self.get_script_args(), 1, client_id])
+            return 1, None
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            self.stage_legacy_cleanup(pipe, client_id)
+            if not paid and not url and legacy.get("confirmation_url"):
+                url = legacy["confirmation_url"]
+                self.stage_pending(pipe, client_id, url)
+            pipe.publish(INVALIDATION_CHANNEL, str(client_id))
+            await pipe.execute()
+
+        return paid, url
+
+    async def convert_legacy(self, batch_size: int = 500) -> int:
+        converted = 0
+        prefix_length = len(self.key(""))
+
+        try:
+            async for key in self.redis.scan_iter(
+                match=self.key("*"), count=batch_size, _type="STRING"
+            ):
+                client_id = key[prefix_length:]
+                if client_id.lstrip("-").isdigit() and await self.read_session(
+                    client_id
+                ):
+                    converted += 1
+        except Exception as e:
+            logger.error(f"Convert {self.namespace} error: {e}", exc_info=True)
+
+        logger.info(f"Converted {converted} legacy {self.namespace} records")
+        return converted
+
+    async def get_session(self, client_id: str) -> dict:
+        client_id = str(client_id)
+        session = self.cache.get(client_id)
+
+        if session is MISSING:
+            generation = self.cache.generation
+            session = await self.read_session(client_id)
+            if session is not None:
+                self.cache.set(client_id, session, generation)
+
+        return dict(session) if session is not None else session
 
     async def add_user(self, client_id: str, confirmation_url: str) -> bool:
         if client_id:
-            return await self.set_key(
-                client_id,
-                {
-                    "confirmation_url": confirmation_url,
-                    "paid": False,
-                },
+            return await self.update_session(
+                client_id, self.stage_pending, confirmation_url
             )
         return False
 
-    async def get_payment_info(self, client_id: str) -> bool:
-        return await self.get_key(client_id)
-
     async def confirm_payment(self, client_id: str) -> bool:
-        info = await self.get_key(client_id)
-        info["paid"] = True
-        if "confirmation_url" in info:
-            del info["confirmation_url"]
-        return await self.set_key(client_id, info)
+        return await self.set_paid([str(client_id)], True) is not None
 
     async def cancel_payment(self, client_id: str) -> bool:
-        info = await self.get_key(client_id)
-        info["paid"] = False
-        if "confirmation_url" in info:
-            del info["confirmation_url"]
-        return await self.set_key(client_id, info)
+        return await self.set_paid([str(client_id)], False) is not None
+
+    async def set_state(self, client_id: str, state: UserState) -> bool:
+        return await self.update_session(client_id, self.stage_state, state)
+
+    async def get_pending_url(self, client_id: str) -> str:
+        return await self.redis.get(self.pending_key(client_id))
+
+    async def get_payment_result(self, client_id: str, target_user: str) -> str:
+        return await self.redis.get(self.payment_result_key(client_id, target_user))
+
+    async def set_payment_result(
+        self, client_id: str, target_user: str, confirmation_url: str
+    ):
+        key = self.payment_result_key(client_id, target_user)
+        await self.redis.set(key, confirmation_url, ex=payment_lock_ttl)
+
+    async def acquire_payment_lock(
+        self, client_id: str, target_user: str, token: str
+    ) -> bool:
+        key = self.payment_lock_key(client_id, target_user)
+        return bool(await self.redis.set(key, token, nx=True, ex=payment_lock_ttl))
+
+    async def release_payment_lock(
+        self, client_id: str, target_user: str, token: str
+    ) -> bool:
+        key = self.payment_lock_key(client_id, target_user)
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                await pipe.watch(key)
+                if await pipe.get(key) != token:
+                    return False
+                pipe.multi()
+                pipe.delete(key)
+                await pipe.execute()
+                return True
+        except WatchError:
+            return False
+        except Exception as e:
+            logger.error(f"Release payment lock error: {e}", exc_info=True)
+            return False
+
+    def forget(self, client_id: str):
+        self.cache.invalidate(str(client_id))
+
+    async def listen_invalidations(self):
+        async def invalidate(client_ids: str):
+            # Bulk updates publish their whole chunk as one space-separated message
+            for client_id in client_ids.split():
+                self.cache.invalidate(client_id)
+
+        async def clear():
+            self.cache.clear()
+
+        await self.listen(INVALIDATION_CHANNEL, invalidate, on_subscribe=clear)
 
 
 class PaymentDatabase(RedisDatabase):
-    def __init__(self):
-        super().__init__(db_number=2)
+    def __init__(self, client=None):
+        super().__init__(namespace="payments", codec=PaymentCodec(), client=client)
 
-    async def get_key(self, key):
-        result = await super().get_key(key)
 
-        if not isinstance(result, dict):
-            result = {"responsible": result, "target_user": result}
+class ImageDatabase(RedisDatabase):
+    def __init__(self, client=None):
+        super().__init__(namespace="images", codec=StringCodec(), client=client)
 
-        return result
+    async def get_file_id(self, image_hash: str) -> str:
+        return await self.get_key(image_hash) or None
 
-    async def create_payment(self, payment_id: str, client_id: str) -> bool:
-        return await self.set_key(payment_id, client_id)
+    async def set_file_id(self, image_hash: str, file_id: str) -> bool:
+        return await self.set_key(image_hash, file_id)
 
-    async def close_payment(self, payment_id: str) -> Dict[str, str]:
-        payment_entity = await self.get_key(payment_id)
 
-        if not isinstance(payment_entity, dict):
-            payment_entity = {
-                "responsible": payment_entity,
-                "target_user": payment_entity,
-            }
+image_files = ImageDatabase()
 
-        await self.delete(payment_id)
-        return payment_entity
 
+class TreeDatabase(RedisDatabase):
+    def __init__(self, client=None):
+        super().__init__(namespace="tree", client=client)
 
-class UserState(Enum):
-    NONE = "none"
-    GIVE_BOT = "give_bot"
+    async def publish_tree(
+        self, version: str, content: str, published_at: float = None
+    ) -> bool:
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.set(self.key(TREE_CONTENT_KEY), content)
+                pipe.set(self.key(TREE_VERSION_KEY), version)
+                pipe.set(self.key(TREE_PUBLISHED_KEY), published_at or time.time())
+                pipe.publish(TREE_CHANNEL, version)
+                await pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"Publish tree error: {e}", exc_info=True)
+            return False
+
+    async def get_version(self) -> str:
+        try:
+            return await self.redis.get(self.key(TREE_VERSION_KEY))
+        except Exception as e:
+            logger.error(f"Get tree version error: {e}", exc_info=True)
 
+    async def get_published(self):
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.get(self.key(TREE_VERSION_KEY))
+                pipe.get(self.key(TREE_PUBLISHED_KEY))
+                version, published_at = await pipe.execute()
+            return version, float(published_at or 0)
+        except Exception as e:
+            logger.error(f"Get tree publication error: {e}", exc_info=True)
+            return None, 0.0
 
-class UserStateDatabase(RedisDatabase):
-    def __init__(self):
-        super().__init__(db_number=3)
+    async def get_tree(self):
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.get(self.key(TREE_VERSION_KEY))
+                pipe.get(self.key(TREE_CONTENT_KEY))
+                return tuple(await pipe.execute())
+        except Exception as e:
+            logger.error(f"Get tree error: {e}", exc_info=True)
+            return None, None
 
-    async def set_state(self, client_id: str, state: UserState) -> bool:
-        return await self.set_key(client_id, state.value)
 
-    async def check_state(self, client_id: str, state: UserState) -> bool:
-        client_state = await self.get_key(client_id)
+trees = TreeDatabase()
+
 
-        return client_state == state.value
+class PaymentTransition(NamedTuple):
+    applied: bool
+    previous_status: Optional[str]
+    target_user: Optional[str]
+    responsible: Optional[str]
+    previous_paid: Optional[bool]
 
 
-user_states = UserStateDatabase()
+def parse_transition(result: list) -> PaymentTransition:
+    applied, status, target_user, responsible, paid = result
+    return PaymentTransition(
+        applied=bool(applied),
+        previous_status=status or None,
+        target_user=target_user or None,
+        responsible=responsible or None,
+        previous_paid={"1": True, "0": False}.get(paid),
+    )
 
 
 class PaymentManager:
 
-    def __init__(self):
-        self.payments = PaymentDatabase()
-        self.users = UserDatabase()
+    def __init__(self, client=None):
+        self.client = client or redis
+        self.payments = PaymentDatabase(self.client)
+        self.users = UserDatabase(self.client)
+        self.create_script = self.client.register_script(CREATE_PAYMENT_SCRIPT)
+        self.close_script = self.client.register_script(CLOSE_PAYMENT_SCRIPT)
+
+    def get_script_args(self) -> list:
+        return self.users.get_script_args()
+
+    async def load_scripts(self):
+        for script in (self.create_script, self.close_script):
+            await self.client.script_load(script.script)
+        await self.users.load_scripts()
 
     async def create_payment(
         self,
@@ -146,96 +515,187 @@ class PaymentManager:
         confirmation_url: str,
         target_user: str = None,
     ) -> str:
-        target_user = target_user or client_id
+        target_user = str(target_user or client_id)
         logger.info(
             f"Create payment {payment_id} for client {client_id} (target user - {target_user}): {confirmation_url}"
         )
-        async with self.payments.redis.pipeline(transaction=True) as pipe_payments:
-            pipe_payments.set(
-                payment_id,
-                json.dumps(
-                    {
-                        "target_user": target_user,
-                        "responsible": client_id,
-                    }
-                ),
+        try:
+            transition = parse_transition(
+                await self.create_script(
+                    keys=[self.payments.key(payment_id)],
+                    args=[
+                        *self.get_script_args(),
+                        target_user,
+                        str(client_id),
+                        confirmation_url,
+                        pending_payment_ttl,
+                    ],
+                )
             )
+            if not transition.applied:
+                logger.info(f"Payment {payment_id} already exists")
+            return confirmation_url
+        except Exception as e:
+            logger.error(f"Create payment {payment_id} error: {e}", exc_info=True)
+        finally:
+            self.users.forget(target_user)
 
-            async with self.users.redis.pipeline(transaction=True) as pipe_users:
-                pipe_users.set(
-                    target_user,
-                    json.dumps({"confirmation_url": confirmation_url, "paid": False}),
+    async def close_payment(self, payment_id: str, status: str) -> PaymentTransition:
+        try:
+            transition = parse_transition(
+                await self.close_script(
+                    keys=[self.payments.key(payment_id)],
+                    args=[*self.get_script_args(), status, processed_payment_ttl],
                 )
+            )
+        except Exception as e:
+            logger.error(f"Close payment {payment_id} error: {e}", exc_info=True)
+            return None
 
-                results_payments, results_users = await asyncio.gather(
-                    pipe_payments.execute(), pipe_users.execute()
-                )
+        if transition.target_user:
+            self.users.forget(transition.target_user)
+        return transition
 
-                if all(results_payments) and all(results_users):
-                    return confirmation_url
-                else:
-                    await self.users.cancel_payment(target_user)
-                    await self.payments.close_payment(payment_id)
+    async def confirm_payment(self, payment_id: str) -> PaymentTransition:
+        logger.info(f"Confirm payment {payment_id}")
+        return await self.close_payment(payment_id, PAYMENT_SUCCEEDED)
 
-    async def confirm_payment(self, client_id: str, payment_id: str) -> bool:
-        logger.info(f"Confirm payment {payment_id} for client {client_id}")
-        async with self.users.redis.pipeline(transaction=True) as pipe_users:
-            payment_entity = json.dumps({"paid": True})
-            pipe_users.set(client_id, payment_entity)
+    async def cancel_payment(self, payment_id: str) -> PaymentTransition:
+        logger.info(f"Cancel payment {payment_id}")
+        return await self.close_payment(payment_id, PAYMENT_CANCELED)
 
-            async with self.payments.redis.pipeline(transaction=True) as pipe_payments:
-                pipe_payments.delete(payment_id)
 
-                results_users, results_payments = await asyncio.gather(
-                    pipe_users.execute(), pipe_payments.execute()
-                )
+payments = PaymentManager()
 
-                return all(results_users) and all(results_payments)
 
-    async def cancel_payment(self, client_id: str, payment_id: str) -> bool:
-        logger.info(f"Cancel payment {payment_id} for client {client_id}")
+class PaymentEvent(NamedTuple):
+    entry_id: str
+    event: str
+    payment_id: str
 
-        if not client_id:
-            return False
 
-        async with self.users.redis.pipeline(transaction=True) as pipe_users:
-            pipe_users.set(client_id, json.dumps({"paid": False}))
+def parse_events(entries: list) -> list:
+    return [
+        PaymentEvent(entry_id, fields.get("event"), fields.get("payment_id"))
+        for entry_id, fields in entries
+        if fields is not None
+    ]
 
-            async with self.payments.redis.pipeline(transaction=True) as pipe_payments:
-                pipe_payments.delete(payment_id)
 
-                results_users, results_payments = await asyncio.gather(
-                    pipe_users.execute(), pipe_payments.execute()
-                )
+class PaymentEventDatabase(RedisDatabase):
+    def __init__(self, client=None):
+        super().__init__(namespace="webhooks", client=client)
+        self.enqueue_script = self.redis.register_script(ENQUEUE_EVENT_SCRIPT)
 
-                return all(results_users) and all(results_payments)
+    def stream_key(self) -> str:
+        return self.key(EVENT_STREAM_KEY)
 
+    def dead_key(self) -> str:
+        return self.key(EVENT_DEAD_KEY)
+
+    def seen_key(self, event: str, payment_id: str) -> str:
+        return self.key(f"{EVENT_SEEN_PREFIX}{event}:{payment_id}")
+
+    async def load_scripts(self):
+        await self.redis.script_load(self.enqueue_script.script)
+
+    async def enqueue(self, event: str, payment_id: str) -> bool:
+        entry_id = await self.enqueue_script(
+            keys=[self.seen_key(event, payment_id), self.stream_key()],
+            args=[payment_id, event_dedup_ttl, event_stream_max_length, event],
+        )
+        return entry_id is not None
+
+    async def create_group(self):
+        try:
+            await self.redis.xgroup_create(
+                self.stream_key(), EVENT_GROUP, id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def read(self, consumer: str, count: int, block: int) -> list:
+        result = await self.redis.xreadgroup(
+            EVENT_GROUP, consumer, {self.stream_key(): ">"}, count=count, block=block
+        )
+        return parse_events(result[0][1]) if result else []
+
+    async def claim(self, consumer: str, min_idle: int, count: int) -> list:
+        result = await self.redis.xautoclaim(
+            self.stream_key(), EVENT_GROUP, consumer, min_idle, count=count
+        )
+        return parse_events(result[1])
+
+    async def ack(self, event: PaymentEvent):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.xack(self.stream_key(), EVENT_GROUP, event.entry_id)
+            pipe.xdel(self.stream_key(), event.entry_id)
+            await pipe.execute()
+
+    async def dead_letter(self, event: PaymentEvent, error: str):
+        record = {**event._asdict(), "error": error}
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(self.dead_key(), self.codec.encode(record))
+            pipe.delete(self.seen_key(event.event, event.payment_id))
+            pipe.xack(self.stream_key(), EVENT_GROUP, event.entry_id)
+            pipe.xdel(self.stream_key(), event.entry_id)
+            await pipe.execute()
+
+    async def count_dead(self) -> int:
+        return await self.redis.llen(self.dead_key())
 
-payments = PaymentManager()
+
+payment_events = PaymentEventDatabase()
 
 
 async def check_db():
-    payments_ping = await payments.payments.redis.ping()
-    assert payments_ping, "Payments ping failed"
-    users_ping = await payments.users.redis.ping()
-    assert users_ping, "Users ping failed"
+    ping = await redis.ping()
+    assert ping, "Redis ping failed"
 
 
 async def initialize_db():
+    await payments.load_scripts()
+    await payment_events.load_scripts()
+    await payment_events.create_group()
     privileged_users = os.environ.get("PAYMENT_PRIVILEGED_USERS").split(",")
     await add_priveleged_users(privileged_users)
 
 
-async def add_priveleged_users(privileged_users: Union[Iterable[int], int]):
+async def add_priveleged_users(
+    privileged_users: Union[Iterable[int], int], progress=None
+) -> Dict[str, int]:
 
     if not isinstance(privileged_users, (list, set, tuple)):
         privileged_users = [privileged_users]
 
-    for user in privileged_users:
-        await payments.users.add_user(user, "")
-        await payments.users.confirm_payment(user)
+    client_ids = list(dict.fromkeys(str(user).strip() for user in privileged_users))
+    client_ids = [client_id for client_id in client_ids if client_id]
+    counts = {"total": len(client_ids), "granted": 0, "already": 0, "failed": 0}
+
+    for start in range(0, len(client_ids), privileged_chunk_size):
+        chunk = client_ids[start : start + privileged_chunk_size]
+        already = await payments.users.grant_access(chunk)
+
+        if already is None:
+            counts["failed"] += len(chunk)
+        else:
+            counts["already"] += already
+            counts["granted"] += len(chunk) - already
+
+        if progress:
+            await progress(start + len(chunk), len(client_ids))
+
+    logger.info(f"Privileged users import: {counts}")
+    return counts
+
+
+async def convert_legacy_records():
+    for database in (payments.payments, payments.users, image_files):
+        await database.convert_legacy()
 
 
 async def close_connections():
-    await payments.payments.close()
-    await payments.users.close()
+    await redis.aclose()
+    if hasattr(redis, "connection_pool"):
+        await redis.connection_pool.disconnect()
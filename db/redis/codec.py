@@ -0,0 +1,61 @@
+from abc import ABC, abstractmethod
+import json
+
+compact_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+# Values are written by our own encoders without surrounding whitespace, so
+# raw_decode skips the two whitespace scans JSONDecoder.decode does per call.
+# Input it does not consume to the end goes through json.loads, which allows
+# trailing whitespace and rejects anything else
+decoder = json.JSONDecoder()
+
+
+def decode_json(raw: str):
+    value, end = decoder.raw_decode(raw)
+    if end != len(raw):
+        return json.loads(raw)
+    return value
+
+
+class Codec(ABC):
+    @abstractmethod
+    def encode(self, value) -> str:
+        pass
+
+    @abstractmethod
+    def decode(self, raw: str):
+        pass
+
+    def is_legacy(self, raw: str) -> bool:
+        return False
+
+
+class JsonCodec(Codec):
+    def encode(self, value) -> str:
+        return compact_encoder.encode(value)
+
+    def decode(self, raw: str):
+        return decode_json(raw)
+
+
+class StringCodec(Codec):
+    def encode(self, value) -> str:
+        return str(value)
+
+    def decode(self, raw: str):
+        return decode_json(raw) if self.is_legacy(raw) else raw
+
+    def is_legacy(self, raw: str) -> bool:
+        return raw[:1] == '"'
+
+
+class PaymentCodec(JsonCodec):
+    def decode(self, raw: str):
+        value = decode_json(raw)
+
+        if not isinstance(value, dict):
+            value = {"responsible": value, "target_user": value}
+
+        return value
+
+    def is_legacy(self, raw: str) -> bool:
+        return raw[:1] != "{"
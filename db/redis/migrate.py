@@ -0,0 +1,129 @@
+"""Copy data from the old one-database-per-entity layout into the namespaced keyspace.
+
+Copied user records are then folded into the paid bitmap and pending keys.
+
+Run from the repository root: python -m db.redis.migrate [--delete] [--dry-run]
+"""
+
+import argparse
+import asyncio
+
+from redis import asyncio as aioredis
+
+from db.redis.client import (
+    connection_string,
+    database_number,
+    image_files,
+    password,
+    payments,
+    trees,
+    user,
+)
+
+SOURCES = {
+    1: payments.users.namespace,
+    2: payments.payments.namespace,
+    4: image_files.namespace,
+    5: trees.namespace,
+}
+BATCH_SIZE = 500
+
+
+def get_client(db_number: int):
+    return aioredis.from_url(
+        connection_string, username=user, password=password, db=db_number
+    )
+
+
+def get_target_key(namespace: str, key: bytes) -> bytes:
+    prefix = f"{namespace}:".encode()
+    return key if key.startswith(prefix) else prefix + key
+
+
+async def copy_keys(source, target, namespace: str, keys: list, delete: bool) -> int:
+    async with source.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        results = await pipe.execute()
+
+    copied = 0
+    async with target.pipeline(transaction=False) as pipe:
+        for key, value, ttl in zip(keys, results[::2], results[1::2]):
+            if value is None:
+                continue
+            pipe.restore(
+                get_target_key(namespace, key), max(ttl, 0), value, replace=True
+            )
+            copied += 1
+        await pipe.execute()
+
+    if delete:
+        await source.delete(*keys)
+    return copied
+
+
+async def migrate_database(source, target, namespace: str, delete: bool, dry_run: bool):
+    found = copied = 0
+    keys = list()
+
+    async def flush():
+        nonlocal copied
+        if not dry_run:
+            copied += await copy_keys(source, target, namespace, keys, delete)
+        keys.clear()
+
+    async for key in source.scan_iter(count=BATCH_SIZE):
+        keys.append(key)
+        found += 1
+        if len(keys) >= BATCH_SIZE:
+            await flush()
+    if keys:
+        await flush()
+
+    return found, copied
+
+
+async def migrate(delete: bool, dry_run: bool):
+    if database_number in SOURCES:
+        raise SystemExit(
+            f"DB_NUMBER={database_number} is used by the old layout, "
+            f"choose a database outside {sorted(SOURCES)}"
+        )
+
+    target = get_client(database_number)
+    try:
+        for db_number, namespace in SOURCES.items():
+            source = get_client(db_number)
+            try:
+                found, copied = await migrate_database(
+                    source, target, namespace, delete, dry_run
+                )
+            finally:
+                await source.aclose()
+            print(
+                f"db {db_number} -> {namespace}:*  found {found}, copied {copied}"
+                + (" (dry run)" if dry_run else "")
+            )
+
+        if not dry_run:
+            converted = await payments.users.convert_legacy()
+            print(f"users folded into the paid bitmap: {converted}")
+    finally:
+        await target.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--delete", action="store_true", help="delete source keys once copied"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only count the keys to migrate"
+    )
+    args = parser.parse_args()
+    asyncio.run(migrate(args.delete, args.dry_run))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import json
+
+PAYMENT_PENDING = "pending"
+PAYMENT_SUCCEEDED = "succeeded"
+PAYMENT_CANCELED = "canceled"
+
+# Every script receives the users key prefix, the paid shard bits and the
+# invalidation channel as ARGV[1..3]; user keys are derived from the id.
+COMMON = """
+local users_prefix = ARGV[1]
+local shard_size = 2 ^ tonumber(ARGV[2])
+local channel = ARGV[3]
+
+local function to_id(value)
+    if type(value) == "number" then
+        return string.format("%d", value)
+    end
+    return value
+end
+
+local function load_payment(record)
+    local payment = cjson.decode(record)
+    if type(payment) ~= "table" then
+        payment = {target_user = payment, responsible = payment}
+    end
+    payment["target_user"] = to_id(payment["target_user"])
+    payment["responsible"] = to_id(payment["responsible"])
+    return payment
+end
+
+local function get_paid_position(client_id)
+    local number = tonumber(client_id)
+    local value = math.abs(number)
+    local shard = string.format("%d", math.floor(value / shard_size))
+    if number < 0 then
+        shard = "-" .. shard
+    end
+    return shard, value % shard_size
+end
+
+local function set_paid(client_id, paid)
+    local shard, offset = get_paid_position(client_id)
+    local key = users_prefix .. "paid:" .. shard
+    local previous = redis.call("GETBIT", key, offset)
+    if previous ~= paid then
+        redis.call("SETBIT", key, offset, paid)
+        redis.call("INCRBY", users_prefix .. "paid-count", paid == 1 and 1 or -1)
+        if paid == 0 and redis.call("BITCOUNT", key) == 0 then
+            redis.call("DEL", key)
+        end
+    end
+    redis.call("DEL", users_prefix .. "pending:" .. client_id)
+    redis.call("DEL", users_prefix .. client_id)
+    return previous
+end
+
+local function get_paid(client_id)
+    local shard, offset = get_paid_position(client_id)
+    if redis.call("GETBIT", users_prefix .. "paid:" .. shard, offset) == 1 then
+        return "1"
+    end
+
+    local legacy = redis.call("GET", users_prefix .. client_id)
+    if not legacy then
+        return "0"
+    end
+
+    local ok, info = pcall(cjson.decode, legacy)
+    if ok and type(info) == "table" and info["paid"] == true then
+        set_paid(client_id, 1)
+        return "1"
+    end
+    redis.call("DEL", users_prefix .. client_id)
+    return "0"
+end
+"""
+
+# KEYS: payment record
+# ARGV: users prefix, paid shard bits, invalidation channel,
+#       target user, responsible, confirmation url, pending ttl
+CREATE_PAYMENT_SCRIPT = COMMON + """
+local record = redis.call("GET", KEYS[1])
+if record then
+    local payment = load_payment(record)
+    return {0, payment["status"] or "pending", payment["target_user"],
+            payment["responsible"], get_paid(payment["target_user"])}
+end
+
+local target = ARGV[4]
+redis.call("SET", KEYS[1], cjson.encode(
+    {target_user = target, responsible = ARGV[5], status = "pending"}),
+    "EX", ARGV[7])
+
+local paid = get_paid(target)
+if paid ~= "1" then
+    redis.call("SET", users_prefix .. "pending:" .. target, ARGV[6], "EX", ARGV[7])
+end
+redis.call("PUBLISH", channel, target)
+
+return {1, "", target, ARGV[5], paid}
+"""
+
+# KEYS: payment record
+# ARGV: users prefix, paid shard bits, invalidation channel,
+#       new status, processed record ttl
+CLOSE_PAYMENT_SCRIPT = COMMON + """
+local record = redis.call("GET", KEYS[1])
+if not record then
+    return {0, "", "", "", ""}
+end
+
+local payment = load_payment(record)
+local target = payment["target_user"]
+local paid = get_paid(target)
+local status = payment["status"] or "pending"
+
+local allowed = status == "pending"
+    or (status == "succeeded" and ARGV[4] == "canceled")
+if not allowed then
+    return {0, status, target, payment["responsible"], paid}
+end
+
+payment["status"] = ARGV[4]
+redis.call("SET", KEYS[1], cjson.encode(payment), "EX", ARGV[5])
+
+if ARGV[4] == "succeeded" then
+    set_paid(target, 1)
+elseif status == "succeeded" or paid ~= "1" then
+    set_paid(target, 0)
+else
+    redis.call("DEL", users_prefix .. "pending:" .. target)
+end
+redis.call("PUBLISH", channel, target)
+
+return {1, status, target, payment["responsible"], paid}
+"""
+
+# KEYS: none
+# ARGV: users prefix, paid shard bits, invalidation channel,
+#       paid (0 or 1), client ids...
+# Publishes the ids once, as a single space-separated invalidation message
+SET_PAID_SCRIPT = COMMON + """
+local paid = tonumber(ARGV[4])
+local unchanged = 0
+for index = 5, #ARGV do
+    if set_paid(ARGV[index], paid) == paid then
+        unchanged = unchanged + 1
+    end
+end
+if #ARGV > 4 then
+    redis.call("PUBLISH", channel, table.concat(ARGV, " ", 5))
+end
+return unchanged
+"""
+
+# KEYS: dedup marker, event stream
+# ARGV: payment id, dedup ttl, stream max length, event
+ENQUEUE_EVENT_SCRIPT = """
+if not redis.call("SET", KEYS[1], ARGV[1], "NX", "EX", ARGV[2]) then
+    return false
+end
+return redis.call("XADD", KEYS[2], "MAXLEN", "~", ARGV[3], "*",
+    "event", ARGV[4], "payment_id", ARGV[1])
+"""
+
+
+# Python ports of the scripts above for the in-process backend
+# (db.memory.engine). They take the engine's command runner as `call` and
+# must stay behaviourally identical to the Lua versions.
+
+
+def to_id(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return "%d" % value
+    return value
+
+
+def load_payment(record: str) -> dict:
+    payment = json.loads(record)
+    if not isinstance(payment, dict):
+        payment = {"target_user": payment, "responsible": payment}
+    payment["target_user"] = to_id(payment.get("target_user"))
+    payment["responsible"] = to_id(payment.get("responsible"))
+    return payment
+
+
+class ScriptContext:
+    def __init__(self, call, args: list):
+        self.call = call
+        self.users_prefix = args[0]
+        self.shard_bits = int(args[1])
+        self.channel = args[2]
+
+    def get_paid_position(self, client_id: str):
+        number = int(client_id)
+        shard = abs(number) >> self.shard_bits
+        offset = abs(number) & ((1 << self.shard_bits) - 1)
+        return f"-{shard}" if number < 0 else str(shard), offset
+
+    def set_paid(self, client_id: str, paid: int) -> int:
+        prefix = self.users_prefix
+        shard, offset = self.get_paid_position(client_id)
+        key = f"{prefix}paid:{shard}"
+        previous = self.call("getbit", key, offset)
+        if previous != paid:
+            self.call("setbit", key, offset, paid)
+            self.call("incrby", f"{prefix}paid-count", 1 if paid == 1 else -1)
+            if paid == 0 and self.call("bitcount", key) == 0:
+                self.call("delete", key)
+        self.call("delete", f"{prefix}pending:{client_id}")
+        self.call("delete", f"{prefix}{client_id}")
+        return previous
+
+    def get_paid(self, client_id: str) -> str:
+        prefix = self.users_prefix
+        shard, offset = self.get_paid_position(client_id)
+        if self.call("getbit", f"{prefix}paid:{shard}", offset) == 1:
+            return "1"
+
+        legacy = self.call("get", f"{prefix}{client_id}")
+        if not legacy:
+            return "0"
+
+        try:
+            info = json.loads(legacy)
+        except ValueError:
+            info = None
+        if isinstance(info, dict) and info.get("paid") is True:
+            self.set_paid(client_id, 1)
+            return "1"
+        self.call("delete", f"{prefix}{client_id}")
+        return "0"
+
+
+def create_payment(call, keys: list, args: list) -> list:
+    context = ScriptContext(call, args)
+    record = call("get", keys[0])
+    if record:
+        payment = load_payment(record)
+        return [
+            0,
+            payment.get("status") or PAYMENT_PENDING,
+            payment["target_user"],
+            payment["responsible"],
+            context.get_paid(payment["target_user"]),
+        ]
+
+    target = args[3]
+    payment = {"target_user": target, "responsible": args[4], "status": PAYMENT_PENDING}
+    call("set", keys[0], json.dumps(payment), ex=int(args[6]))
+
+    paid = context.get_paid(target)
+    if paid != "1":
+        call("set", f"{context.users_prefix}pending:{target}", args[5], ex=int(args[6]))
+    call("publish", context.channel, target)
+
+    return [1, "", target, args[4], paid]
+
+
+def close_payment(call, keys: list, args: list) -> list:
+    context = ScriptContext(call, args)
+    record = call("get", keys[0])
+    if not record:
+        return [0, "", "", "", ""]
+
+    payment = load_payment(record)
+    target = payment["target_user"]
+    paid = context.get_paid(target)
+    status = payment.get("status") or PAYMENT_PENDING
+    new_status = args[3]
+
+    allowed = status == PAYMENT_PENDING or (
+        status == PAYMENT_SUCCEEDED and new_status == PAYMENT_CANCELED
+    )
+    if not allowed:
+        return [0, status, target, payment["responsible"], paid]
+
+    payment["status"] = new_status
+    call("set", keys[0], json.dumps(payment), ex=int(args[4]))
+
+    if new_status == PAYMENT_SUCCEEDED:
+        context.set_paid(target, 1)
+    elif status == PAYMENT_SUCCEEDED or paid != "1":
+        context.set_paid(target, 0)
+    else:
+        call("delete", f"{context.users_prefix}pending:{target}")
+    call("publish", context.channel, target)
+
+    return [1, status, target, payment["responsible"], paid]
+
+
+def set_paid(call, keys: list, args: list) -> int:
+    context = ScriptContext(call, args)
+    paid = int(args[3])
+    unchanged = 0
+    for client_id in args[4:]:
+        if context.set_paid(client_id, paid) == paid:
+            unchanged += 1
+    if len(args) > 4:
+        call("publish", context.channel, " ".join(args[4:]))
+    return unchanged
+
+
+def enqueue_event(call, keys: list, args: list):
+    if not call("set", keys[0], args[0], nx=True, ex=int(args[1])):
+        return None
+    return call(
+        "xadd",
+        keys[1],
+        {"event": args[3], "payment_id": args[0]},
+        maxlen=int(args[2]),
+        approximate=True,
+    )
+
+
+PYTHON_SCRIPTS = {
+    CREATE_PAYMENT_SCRIPT: create_payment,
+    CLOSE_PAYMENT_SCRIPT: close_payment,
+    SET_PAID_SCRIPT: set_paid,
+    ENQUEUE_EVENT_SCRIPT: enqueue_event,
+}
@@ -4,7 +4,7 @@ import os
 
 from dotenv import load_dotenv
 
-from bot.bot import start_bot
+from bot.bot import enable_webhook, start_bot
 from payment.app import start_app
 
 load_dotenv()
@@ -18,7 +18,7 @@ async def main():
 
     tasks = [asyncio.create_task(start_bot())]
 
-    if enable_payments:
+    if enable_payments or enable_webhook:
         tasks.append(asyncio.create_task(start_app()))
 
     await asyncio.gather(*tasks)
@@ -5,7 +5,11 @@ import os
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager
 from db.redis.client import initialize_db, close_connections, check_db
-from payment.client import configure_payment
+from payment.client import close_payment_client, configure_payment
+from payment.events import start_workers, stop_workers
+from bot.bot import enable_payments, enable_webhook
+from bot.webhook import router as telegram_router
+from bot.status import router as status_router
 
 load_dotenv()
 host = os.environ.get("HOST")
@@ -15,15 +19,22 @@ dev = bool(os.environ.get("DEV"))
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    configure_payment()
-    await check_db()
-    await initialize_db()
+    if enable_payments:
+        configure_payment()
+        await check_db()
+        await initialize_db()
+        start_workers()
     yield
+    await stop_workers()
+    await close_payment_client()
     await close_connections()
 
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(yookassa_router)
+app.include_router(status_router)
+if enable_webhook:
+    app.include_router(telegram_router)
 
 
 async def start_app():
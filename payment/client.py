@@ -1,12 +1,25 @@
-from yookassa import Payment, Configuration
+from yookassa import Configuration
+from yookassa.client import ApiClient
 from yookassa.domain.common import ConfirmationType
+from yookassa.domain.exceptions import (
+    ApiError,
+    BadRequestError,
+    ForbiddenError,
+    NotFoundError,
+    TooManyRequestsError,
+    UnauthorizedError,
+)
 from yookassa.domain.models.currency import Currency
 from yookassa.domain.models.receipt import Receipt, ReceiptItem
 from yookassa.domain.request.payment_request_builder import PaymentRequestBuilder
 from dotenv import load_dotenv
-from db.redis.client import payments
+from db.redis.client import payment_lock_ttl, payments
+from logger_config import logger
+import aiohttp
+import asyncio
 import os
-import json
+import time
+import uuid
 
 load_dotenv()
 
@@ -16,8 +29,110 @@ receipt_phone = os.environ.get("PAYMENT_PHONE")
 webhook_url = os.environ.get("PAYMENT_WEBHOOK_URL")
 cost = float(os.environ.get("PAYMENT_COST"))
 
+api_timeout = float(os.environ.get("PAYMENT_API_TIMEOUT", 10))
+api_attempts = int(os.environ.get("PAYMENT_API_ATTEMPTS", 3))
+api_pool_size = int(os.environ.get("PAYMENT_API_POOL_SIZE", 20))
+idempotency_window = int(os.environ.get("PAYMENT_IDEMPOTENCY_WINDOW", 600))
 
-async def create_payment(client_id: str, target_user: str = None) -> str:
+IDEMPOTENCY_NAMESPACE = uuid.UUID("5b0e8c1e-8a4f-4c59-9d43-6f1b6a4f2c10")
+RETRY_STATUSES = {202, 429, 500, 502, 503, 504}
+MAX_RETRY_DELAY = 5
+PAYMENT_LOCK_POLL = 0.1
+API_ERRORS = {
+    error.HTTP_CODE: error
+    for error in (
+        BadRequestError,
+        ForbiddenError,
+        NotFoundError,
+        TooManyRequestsError,
+        UnauthorizedError,
+    )
+}
+
+
+def get_idempotency_key(client_id: str, target_user: str = None) -> str:
+    window = int(time.time() // idempotency_window)
+    name = f"{client_id}:{target_user or client_id}:{cost}:{window}"
+    return str(uuid.uuid5(IDEMPOTENCY_NAMESPACE, name))
+
+
+def get_retry_delay(response_json: dict, attempt: int) -> float:
+    retry_after = None
+    if isinstance(response_json, dict):
+        retry_after = response_json.get("retry_after")
+    delay = retry_after / 1000 if retry_after else 0.5 * 2**attempt
+    return min(delay, MAX_RETRY_DELAY)
+
+
+async def read_json(response: aiohttp.ClientResponse):
+    try:
+        return await response.json(content_type=None)
+    except ValueError:
+        return None
+
+
+class PaymentApiClient:
+    def __init__(self):
+        self.session = None
+        self.endpoint = None
+        self.headers = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            api_client = ApiClient()
+            self.endpoint = api_client.endpoint
+            self.headers = api_client.prepare_request_headers(None)
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=api_pool_size, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=api_timeout),
+            )
+        return self.session
+
+    async def post(self, path: str, body: dict, idempotency_key: str) -> dict:
+        session = self.get_session()
+        headers = {**self.headers, "Idempotence-Key": idempotency_key}
+
+        for attempt in range(api_attempts):
+            last = attempt == api_attempts - 1
+            try:
+                async with session.post(
+                    self.endpoint + path, json=body, headers=headers
+                ) as response:
+                    status = response.status
+                    response_json = await read_json(response)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if last:
+                    raise
+                logger.info(f"Payment API {path} attempt {attempt + 1} failed: {e}")
+                response_json = None
+            else:
+                if status == 200 and response_json is not None:
+                    return response_json
+                if status not in RETRY_STATUSES or last:
+                    error = API_ERRORS.get(status)
+                    raise (
+                        error(response_json)
+                        if error and response_json is not None
+                        else ApiError(f"{status}: {response_json}")
+                    )
+
+            await asyncio.sleep(get_retry_delay(response_json, attempt))
+
+    async def create_payment(self, request, idempotency_key: str) -> dict:
+        request.validate()
+        return await self.post("/payments", dict(request), idempotency_key)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+api_client = PaymentApiClient()
+in_flight = dict()
+
+
+def build_payment_request():
     receipt = Receipt()
     receipt.tax_system_code = 1
     receipt.items = [
@@ -43,8 +158,23 @@ async def create_payment(client_id: str, target_user: str = None) -> str:
         }
     )
 
-    request = builder.build()
-    payment = json.loads(Payment.create(request).json())
+    return builder.build()
+
+
+async def request_payment(client_id: str, target_user: str = None) -> str:
+    request = build_payment_request()
+    idempotency_key = get_idempotency_key(client_id, target_user)
+
+    try:
+        payment = await api_client.create_payment(request, idempotency_key)
+        if payment.get("status") == "canceled":
+            logger.info(
+                f"Payment {payment.get('id')} for key {idempotency_key} is canceled, creating a new one"
+            )
+            payment = await api_client.create_payment(request, str(uuid.uuid4()))
+    except Exception as e:
+        logger.error(f"Create payment for client {client_id} error: {e}")
+        return None
 
     payment_id = payment.get("id")
     confirmation_url = payment.get("confirmation", {}).get("confirmation_url")
@@ -55,8 +185,65 @@ async def create_payment(client_id: str, target_user: str = None) -> str:
         )
 
 
+async def create_locked_payment(client_id: str, target_user: str) -> str:
+    users = payments.users
+    token = str(uuid.uuid4())
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + payment_lock_ttl
+    waited = False
+
+    try:
+        while not await users.acquire_payment_lock(client_id, target_user, token):
+            if loop.time() > deadline:
+                logger.info(f"Payment lock for client {client_id} is not released")
+                return None
+            waited = True
+            await asyncio.sleep(PAYMENT_LOCK_POLL)
+    except Exception as e:
+        logger.error(f"Payment lock for client {client_id} error: {e}")
+        return None
+
+    try:
+        # pending:<target> may hold the target's own payment, so a gift only
+        # reuses the url created by the lock holder for the same pair
+        if client_id == target_user:
+            confirmation_url = await users.get_pending_url(target_user)
+        elif waited:
+            confirmation_url = await users.get_payment_result(client_id, target_user)
+        else:
+            confirmation_url = None
+        if confirmation_url:
+            return confirmation_url
+
+        confirmation_url = await request_payment(client_id, target_user)
+        if confirmation_url and client_id != target_user:
+            await users.set_payment_result(client_id, target_user, confirmation_url)
+        return confirmation_url
+    except Exception as e:
+        logger.error(f"Create payment for client {client_id} error: {e}")
+        return None
+    finally:
+        await users.release_payment_lock(client_id, target_user, token)
+
+
+async def create_payment(client_id: str, target_user: str = None) -> str:
+    key = (str(client_id), str(target_user or client_id))
+    flight = in_flight.get(key)
+
+    if flight is None:
+        flight = asyncio.ensure_future(create_locked_payment(*key))
+        flight.add_done_callback(lambda _: in_flight.pop(key, None))
+        in_flight[key] = flight
+
+    return await asyncio.shield(flight)
+
+
 def configure_payment():
     account_id = os.environ.get("PAYMENT_ACCOUNT_ID")
     secret_key = os.environ.get("PAYMENT_SECRET_KEY")
     Configuration.configure(account_id, secret_key)
     Configuration.configure_user_agent()
+
+
+async def close_payment_client():
+    await api_client.close()
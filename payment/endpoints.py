@@ -1,87 +1,59 @@
 from fastapi import FastAPI, Request, HTTPException, APIRouter
+from netaddr import AddrFormatError, IPSet
 from yookassa.domain.notification import (
     WebhookNotificationEventType,
     WebhookNotificationFactory,
 )
 from yookassa.domain.common import SecurityHelper
-from db.redis.client import payments
-from bot.bot import (
-    success_payment_message,
-    failure_payment_message,
-    success_payment_for_target_message,
-    success_payment_for_responsible_message,
-)
+from db.redis.client import payment_events
 from logger_config import logger
 
 app = FastAPI()
 
 router = APIRouter(prefix="/infobot")
 
+TRUSTED_NETWORKS = IPSet(SecurityHelper.YOOKASSA_NETWORKS)
+
+
+def is_ip_trusted(ip: str) -> bool:
+    try:
+        return ip in TRUSTED_NETWORKS
+    except (AddrFormatError, TypeError, ValueError):
+        return False
+
 
 @router.post("/payment")
 async def webhook(request: Request):
     logger.info("Payment webhook")
     ip = request.client.host
-    if not SecurityHelper().is_ip_trusted(ip):
+    if not is_ip_trusted(ip):
         logger.info("IP is not in trusted list")
         raise HTTPException(status_code=400)
-    event_json = await request.json()
     try:
+        event_json = await request.json()
         logger.info(f"Event json: {event_json}")
         notification_object = WebhookNotificationFactory().create(event_json)
-        response_object = notification_object.object
-
         payment_status = notification_object.event
-        payment_id = get_id_by_status(response_object, payment_status)
-        payment_entity = await payments.payments.get_key(payment_id)
-        responsible_id = payment_entity.get("responsible")
-        target_id = payment_entity.get("target_user")
-
-        logger.info(
-            f"Payment {payment_id} status: {payment_status} for client {target_id} (responsible - {responsible_id})"
-        )
-
-        if payment_status == WebhookNotificationEventType.PAYMENT_SUCCEEDED:
-            result = await payments.confirm_payment(target_id, payment_id)
-            logger.info(
-                f"Payment {payment_id} confirmation status: {result} for client {target_id}"
-            )
-            if result:
-                logger.info(
-                    f"Send success payment message for client {target_id} (responsible - {responsible_id})"
-                )
-                if target_id == responsible_id:
-                    await success_payment_message(target_id)
-                else:
-                    await success_payment_for_responsible_message(responsible_id)
-                    await success_payment_for_target_message(target_id)
-            else:
-                logger.info(
-                    f"Cancel payment for client {target_id} (responsible - {responsible_id})"
-                )
-                raise HTTPException(status_code=500)
-        else:
-            result = await payments.cancel_payment(target_id, payment_id)
-            logger.info(
-                f"Payment {payment_id} cancelation status: {result} for client {target_id} (responsible - {responsible_id})"
-            )
-
-            if result:
-                logger.info(
-                    f"Cancel payment for client {target_id} (responsible - {responsible_id})"
-                )
-                await failure_payment_message(responsible_id, payment_status)
-            else:
-                logger.info(
-                    f"Send failed cancel payment message for client {target_id} (responsible - {responsible_id}) to YooKassa"
-                )
-                raise HTTPException(status_code=200)
+        payment_id = get_id_by_status(notification_object.object, payment_status)
+    except Exception as e:
+        logger.error(f"Webhook error: {e}", exc_info=True)
+        raise HTTPException(status_code=400)
 
+    if payment_id is None:
+        logger.info(f"Skip {payment_status} event without payment id")
         return {"status": "ok"}
 
+    try:
+        queued = await payment_events.enqueue(payment_status, payment_id)
     except Exception as e:
-        logger.error(f"Webhook error: {e}", exc_info=True)
-        raise HTTPException(status_code=400)
+        logger.error(f"Queue payment {payment_id} event error: {e}", exc_info=True)
+        raise HTTPException(status_code=500)
+
+    logger.info(
+        f"Payment {payment_id} {payment_status} event "
+        + ("queued" if queued else "is a duplicate")
+    )
+    return {"status": "ok"}
 
 
 def get_id_by_status(event_object, status):
@@ -0,0 +1,125 @@
+from yookassa.domain.notification import WebhookNotificationEventType
+from dotenv import load_dotenv
+from db.redis.client import PaymentEvent, PaymentTransition, payment_events, payments
+from bot.bot import (
+    success_payment_message,
+    failure_payment_message,
+    success_payment_for_target_message,
+    success_payment_for_responsible_message,
+)
+from logger_config import logger
+import asyncio
+import os
+import socket
+
+load_dotenv()
+
+workers_count = int(os.environ.get("PAYMENT_EVENT_WORKERS", 4))
+event_attempts = int(os.environ.get("PAYMENT_EVENT_ATTEMPTS", 5))
+
+READ_COUNT = 10
+READ_BLOCK = 5000
+MAX_RETRY_DELAY = 30
+
+# Pending events are reclaimed only from consumers that stopped working on
+# them, so the idle time must outlast an event's own retries
+retry_budget = sum(
+    min(2**attempt, MAX_RETRY_DELAY) for attempt in range(event_attempts)
+)
+claim_idle = 1000 * max(
+    int(os.environ.get("PAYMENT_EVENT_CLAIM_IDLE", 300)), 2 * retry_budget
+)
+
+workers = set()
+
+
+class PaymentEventError(Exception):
+    pass
+
+
+async def close_payment(event: PaymentEvent) -> PaymentTransition:
+    if event.event == WebhookNotificationEventType.PAYMENT_SUCCEEDED:
+        transition = await payments.confirm_payment(event.payment_id)
+    else:
+        transition = await payments.cancel_payment(event.payment_id)
+
+    if transition is None:
+        raise PaymentEventError(f"Payment {event.payment_id} transition failed")
+
+    logger.info(
+        f"Payment {event.payment_id} {event.event} status: {transition.applied} for client {transition.target_user} (responsible - {transition.responsible}), previous status: {transition.previous_status}"
+    )
+    return transition
+
+
+def get_messages(event: PaymentEvent, transition: PaymentTransition) -> list:
+    if not transition.applied:
+        return []
+
+    target_id = transition.target_user
+    responsible_id = transition.responsible
+
+    if event.event != WebhookNotificationEventType.PAYMENT_SUCCEEDED:
+        return [(failure_payment_message, (responsible_id, event.event))]
+    if target_id == responsible_id:
+        return [(success_payment_message, (target_id,))]
+    return [
+        (success_payment_for_responsible_message, (responsible_id,)),
+        (success_payment_for_target_message, (target_id,)),
+    ]
+
+
+async def process_event(event: PaymentEvent):
+    messages = None
+
+    for attempt in range(event_attempts):
+        try:
+            if messages is None:
+                messages = get_messages(event, await close_payment(event))
+            while messages:
+                send, args = messages[0]
+                await send(*args)
+                messages.pop(0)
+            break
+        except Exception as e:
+            error = e
+            logger.error(
+                f"Payment event {event.entry_id} attempt {attempt + 1} error: {e}"
+            )
+            if attempt < event_attempts - 1:
+                await asyncio.sleep(min(2**attempt, MAX_RETRY_DELAY))
+    else:
+        logger.error(f"Payment event {event.entry_id} moved to dead letters")
+        await payment_events.dead_letter(event, str(error))
+        return
+
+    await payment_events.ack(event)
+
+
+async def run_worker(consumer: str):
+    while True:
+        try:
+            events = await payment_events.claim(consumer, claim_idle, READ_COUNT)
+            if not events:
+                events = await payment_events.read(consumer, READ_COUNT, READ_BLOCK)
+            for event in events:
+                await process_event(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Payment events worker {consumer} error: {e}", exc_info=True)
+            await asyncio.sleep(1)
+
+
+def start_workers():
+    prefix = f"{socket.gethostname()}-{os.getpid()}"
+    for index in range(workers_count):
+        task = asyncio.create_task(run_worker(f"{prefix}-{index}"))
+        workers.add(task)
+
+
+async def stop_workers():
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
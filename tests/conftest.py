@@ -0,0 +1,5 @@
+import os
+
+os.environ.setdefault("DB_HOST", "localhost")
+os.environ.setdefault("DB_PORT", "6379")
+os.environ.setdefault("DB_BACKEND", "memory")
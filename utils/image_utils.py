@@ -1,57 +1,141 @@
 from PIL import Image
+import hashlib
+import io
 import os
+import shutil
+from uuid import uuid4 as uuid
 from dotenv import load_dotenv
+from logger_config import logger
 
 load_dotenv()
 
 IMAGES_PATH = os.environ.get("IMAGES_PATH")
+IMAGES_CACHE_PATH = os.environ.get("IMAGES_CACHE_PATH") or os.path.join(
+    IMAGES_PATH or ".", ".cache"
+)
+IMAGES_WORKERS = int(os.environ.get("IMAGES_WORKERS") or os.cpu_count() or 1)
+
+MIN_SIZE = 10
+MAX_SIZE = 5000
+TARGET_SIZE_KB = 550
+MIN_QUALITY = 10
+MAX_QUALITY = 85
+QUALITY_STEP = 5
+MAX_DOWNSCALES = 3
+PREPARE_PARAMS = (
+    f"r{MIN_SIZE}-{MAX_SIZE}_c{TARGET_SIZE_KB}_q{MIN_QUALITY}-{MAX_QUALITY}"
+)
+
+
+def get_source_hash(image_path: str) -> str:
+    hash_function = hashlib.sha256()
+    with open(image_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            hash_function.update(chunk)
+    return hash_function.hexdigest()
+
+
+def get_cache_path(image_path: str) -> str:
+    source_hash = get_source_hash(image_path)
+    return os.path.join(
+        IMAGES_CACHE_PATH, source_hash[:2], f"{source_hash}_{PREPARE_PARAMS}.jpg"
+    )
+
+
+def get_image_hash(cache_path: str) -> str:
+    return os.path.splitext(os.path.basename(cache_path))[0]
 
 
 def prepare_image(image_path):
-    resized_image = resize_image(image_path)
-    compressed_image = compress_image(resized_image)
+    cache_path = get_cache_path(image_path)
+    if os.path.exists(cache_path):
+        return cache_path
 
-    return compressed_image
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{uuid()}.tmp"
 
+    try:
+        with Image.open(image_path) as img:
+            target_size = get_target_size(img.width, img.height)
+            fits = os.path.getsize(image_path) <= TARGET_SIZE_KB * 1024
 
-def get_modified_filepath(image_path: str, prefix: str):
-    filename = image_path[image_path.rindex("/") + 1 :]
-    image_path = image_path[: image_path.rindex("/") + 1]
-    modified_path = f"{image_path}{prefix}_{filename}"
+            if img.format == "JPEG" and target_size == img.size and fits:
+                shutil.copyfile(image_path, tmp_path)
+            else:
+                img = resize_image(img, target_size)
+                with open(tmp_path, "wb") as file:
+                    file.write(compress_image(img))
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-    return modified_path
+    return cache_path
 
 
 def get_image_path(filename: str):
     return os.path.join(IMAGES_PATH, f"{filename}.jpg")
 
 
-def compress_image(image_path, target_size_kb=550):
-    compressed_path = image_path
+def get_target_size(width: int, height: int):
+    scale = min(1, MAX_SIZE / width, MAX_SIZE / height)
+    scale = max(scale, MIN_SIZE / width, MIN_SIZE / height)
+
+    return (
+        min(max(MIN_SIZE, round(width * scale)), MAX_SIZE),
+        min(max(MIN_SIZE, round(height * scale)), MAX_SIZE),
+    )
+
+
+def encode_jpeg(img: Image.Image, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def compress_image(img: Image.Image, target_size_kb=TARGET_SIZE_KB) -> bytes:
+    target_size = target_size_kb * 1024
+
+    for downscale in range(MAX_DOWNSCALES + 1):
+        data = encode_jpeg(img, MAX_QUALITY)
+        if len(data) <= target_size:
+            return data
 
-    while os.path.getsize(compressed_path) > target_size_kb * 1024:
-        with Image.open(compressed_path) as img:
-            compressed_path = get_modified_filepath(image_path, "compressed")
-            img.save(compressed_path, format="JPEG", quality=10)
-    return compressed_path
+        smallest = encode_jpeg(img, MIN_QUALITY)
+        if len(smallest) <= target_size:
+            low, high, data = MIN_QUALITY, MAX_QUALITY, smallest
+            while high - low > QUALITY_STEP:
+                quality = (low + high) // 2
+                candidate = encode_jpeg(img, quality)
+                if len(candidate) <= target_size:
+                    low, data = quality, candidate
+                else:
+                    high = quality
+            return data
+        if downscale == MAX_DOWNSCALES:
+            break
 
+        scale = max(0.1, 0.9 * (target_size / len(smallest)) ** 0.5)
+        img = img.resize(
+            (max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+            Image.LANCZOS,
+        )
 
-def resize_image(image_path):
-    min_size = 10
-    max_size = 5000
+    logger.warning(
+        f"Image {img.width}x{img.height} is {len(smallest) / 1024:.1f} KB after "
+        f"{MAX_DOWNSCALES} downscales, over the {target_size_kb} KB target"
+    )
+    return smallest
 
-    with Image.open(image_path) as img:
-        img_width = img.width
-        img_height = img.height
 
-        if min_size <= img_width <= max_size and min_size <= img_height <= max_size:
-            return image_path
+def resize_image(img: Image.Image, target_size) -> Image.Image:
+    if img.format == "JPEG":
+        img.draft("RGB", target_size)
 
-        img_width = min(max(min_size, img_width), max_size)
-        img_height = min(max(min_size, img_height), max_size)
-        img = img.resize((img_width, img_height), Image.LANCZOS)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
 
-        resized_path = get_modified_filepath(image_path, "resized")
+    if img.size != target_size:
+        img = img.resize(target_size, Image.LANCZOS)
 
-        img.save(resized_path, quality=50)
-        return resized_path
+    return img